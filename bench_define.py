@@ -0,0 +1,22 @@
+import time
+
+from scale import scale
+
+
+def define_kernels(n):
+    kernels = []
+    for k in range(n):
+        @scale.anonymous
+        def kernel(a: [float], l: int) -> float:
+            s = 0.0
+            for i in range(l):
+                s += a[i] * {k}
+            return s
+        kernels.append(kernel)
+    return kernels
+
+for n in (100, 1000):
+    start = time.perf_counter()
+    define_kernels(n)
+    elapsed = time.perf_counter() - start
+    print('{} definitions: {:.3f}s, {:.0f} definitions/s'.format(n, elapsed, n / elapsed))
@@ -0,0 +1,24 @@
+import time
+
+from bf import compile as compile_bf
+from img import Image, compile_ir_image_wide, compile_ir_blocked
+
+HELLO_WORLD = ('++++++++++[>+++++++>++++++++++>+++>+<<<<-]>++.>+.+++++++..+++.>++.'
+               '<<+++++++++++++++.>.+++.------.--------.>+.>.')
+
+def blur(a):
+    blur_x = (a.shift(-1,0) + a + a.shift(1,0))*(1.0/3.0)
+    return (blur_x.shift(0,-1) + blur_x + blur_x.shift(0,1))*(1.0/3.0)
+
+def bench(label, stage, repeat):
+    stage()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        stage()
+    elapsed = (time.perf_counter() - start) / repeat
+    print('{}: {:.2f}ms per definition'.format(label, elapsed * 1000))
+
+tree = blur(blur(Image.input(0))).tree
+bench('bf hello world x8', lambda: compile_bf(HELLO_WORLD * 8, 256), 20)
+bench('img image_wide blur x2', lambda: compile_ir_image_wide(tree), 20)
+bench('img blocked blur x2', lambda: compile_ir_blocked(tree), 20)
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from scale import scale
+from scale.frontend import Frontend
+from scale.interpreter import Interpreter
+
+@scale
+def dot(a: [float], b: [float], n: int) -> float:
+    s = 0.0
+    for i in range(n):
+        s = s + a[i] * b[i]
+    return s
+
+@scale
+def laplace(img: [float], out: [float], l: int) -> int:
+    for i in range(l - 2):
+        for j in range(l - 2):
+            out[i*l + j] = img[i*l + j+1] + img[(i+2)*l + j+1] + img[(i+1)*l + j+2] + img[(i+1)*l + j] - 4.0 * img[(i+1)*l + j+1]
+    return 0
+
+@scale
+def collatz(n: int) -> int:
+    steps = 0
+    for k in range(1, n):
+        x = k
+        for j in range(1000):
+            if x != 1:
+                if x % 2 == 0:
+                    x = int(x / 2)
+                else:
+                    x = 3 * x + 1
+                steps = steps + 1
+    return steps
+
+def best_of(f, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+n = 200
+values = np.random.rand(n * n).tolist()
+cases = [
+    (dot, (values, values, n * n)),
+    (laplace, (values, [0.0] * (n * n), n)),
+    (collatz, (300,)),
+]
+print('{:>8} {:>12} {:>12} {:>12} {:>8}'.format('', 'tree walker', 'interpreted', 'native', 'speedup'))
+for fn, args in cases:
+    fn.compile()
+    ir = Frontend().visit(fn.job.unescaped)
+    walker, expected = best_of(lambda: Interpreter().call_fun(ir, *args))
+    interpreted, result = best_of(lambda: fn.interpret(*args))
+    native, _ = best_of(lambda: fn(*args))
+    assert result == expected
+    print('{:>8} {:>10.1f}ms {:>10.1f}ms {:>10.3f}ms {:>7.1f}x'.format(
+        fn.scale_name, walker * 1e3, interpreted * 1e3, native * 1e3, walker / interpreted))
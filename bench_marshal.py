@@ -0,0 +1,46 @@
+import array
+import ctypes
+import time
+
+import numpy as np
+
+from scale import scale
+
+# touches one element, so the time per call is the cost of passing the arguments
+@scale
+def first(a: [float]) -> float:
+    return a[0]
+
+@scale
+def corner(a: [[float]]) -> float:
+    return a[0, 0]
+
+def per_call(fn, *args):
+    calls = max(1, min(10000, 2000000 // len(args[0])))
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn(*args)
+    return (time.perf_counter() - start) / calls * 1e6
+
+def element_copy(values):
+    # what passing a list cost before: one ctypes conversion per element, one per copy-back
+    buf = (ctypes.c_double * len(values))(*values)
+    for i in range(len(values)):
+        values[i] = buf[i]
+
+print('{:>8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+    'size', 'ndarray', 'array.array', 'memoryview', 'list', 'list 2d', 'per element'))
+for n in (10, 1000, 100000, 1000000):
+    data = np.random.rand(n)
+    values = data.tolist()
+    rows = data.reshape(-1, 10).tolist() if n >= 10 else [values]
+    times = [
+        per_call(first, data),
+        per_call(first, array.array('d', values)),
+        per_call(first, memoryview(bytearray(data.tobytes())).cast('d')),
+        per_call(first, values),
+        per_call(corner, rows),
+        per_call(element_copy, values),
+    ]
+    print('{:>8} '.format(n) + ' '.join('{:>10.1f}us'.format(t) for t in times))
@@ -0,0 +1,56 @@
+import os
+import time
+
+import numpy as np
+
+from scale import scale, prange
+from img import ConcreteImage, Image
+
+def thread_counts():
+    counts, n = [], 1
+    while n < (os.cpu_count() or 1):
+        counts.append(n)
+        n *= 2
+    return counts + [os.cpu_count() or 1]
+
+def best_of(f, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def define_laplace(num_threads):
+    @scale.anonymous(num_threads=num_threads)
+    def laplace(img: [float], out: [float], l: int) -> int:
+        for i in prange(l-2):
+            for j in range(l-2):
+                out[i*l + j] = img[i*l + j+1] + img[(i+2)*l + j+1] + img[(i+1)*l + j+2] + img[(i+1)*l + j] - 4.0 * img[(i+1)*l + j+1]
+        return 0
+    return laplace
+
+def blur(a):
+    blur_x = (a.shift(-1,0) + a + a.shift(1,0))*(1.0/3.0)
+    return (blur_x.shift(0,-1) + blur_x + blur_x.shift(0,1))*(1.0/3.0)
+
+N = 2048
+img = np.random.rand(N * N)
+out = np.zeros(N * N)
+image = ConcreteImage(N, N, list(img))
+
+base = {}
+for n in thread_counts():
+    laplace = define_laplace(n)
+    laplace(img, out, N)
+    t = best_of(lambda: laplace(img, out, N))
+    base.setdefault('laplace', t)
+    print('laplace {}x{}, {} threads: {:.2f}ms ({:.1f}x)'.format(N, N, n, t * 1000, base['laplace'] / t))
+
+    # img.py kernels are compiled when first run, with the thread count set at definition
+    os.environ['SCALE_NUM_THREADS'] = str(n)
+    pipeline = blur(Image.input(0))
+    pipeline.run('image_wide', image)
+    t = best_of(lambda: pipeline.run('image_wide', image), 3)
+    base.setdefault('blur', t)
+    print('blur {}x{}, {} threads: {:.2f}ms ({:.1f}x)'.format(N, N, n, t * 1000, base['blur'] / t))
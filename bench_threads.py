@@ -0,0 +1,57 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from scale import scale
+
+def run_threads(n, target):
+    barrier = threading.Barrier(n)
+    def worker():
+        barrier.wait()
+        target()
+    threads = [threading.Thread(target=worker) for _ in range(n)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def thread_counts():
+    counts, n = [], 1
+    while n < 2 * (os.cpu_count() or 1):
+        counts.append(n)
+        n *= 2
+    return counts
+
+compiled = []
+scale.on_compile(lambda stats: compiled.append(stats['name']))
+
+# many threads making the first call at once should compile the function once
+@scale
+def total(a: [float], n: int) -> float:
+    s = 0.0
+    for i in range(n):
+        s += a[i] * a[i]
+    return s
+
+N = 200000
+data = np.random.rand(N)
+expected = float((data * data).sum())
+errors = []
+def first_call():
+    if abs(total(data, N) - expected) > 1e-6 * expected:
+        errors.append('wrong result')
+run_threads(16, first_call)
+print('first call from 16 threads: compiled {} time(s), {} errors'.format(compiled.count('total'), len(errors)))
+
+CALLS = 200
+for n in thread_counts():
+    def calls():
+        call = total.bind(data, N)
+        for _ in range(CALLS):
+            call()
+    elapsed = run_threads(n, calls)
+    print('{} threads: {:.0f} calls/s'.format(n, n * CALLS / elapsed))
@@ -7,14 +7,6 @@ import ast
 import operator
 import re
 
-@scale.native
-def malloc(x: int) -> [float]:
-    pass
-
-@scale.native
-def free(x: [float]) -> int:
-    pass
-
 # represents a node in the IR
 class IRNode:
     def __init__(self, kind, **kwargs):
@@ -155,7 +147,7 @@ class Image:
         return result
 
 @scale
-def load_data(W: int, H: int, data: [float], x: int, y: int) -> float:
+def load_data(W: int, H: int, data: In[[float]], x: int, y: int) -> float:
     x = ((x % W) + W) % W
     y = ((y % H) + H) % H
     return data[y * W + x]
@@ -179,9 +171,9 @@ def compile_ir_recompute(tree):
             xn, yn = q[ast_literal[x] + u[tree.sx]],q[ast_literal[y] + u[tree.sy]]
             return gen_tree(tree.value,xn,yn)
 
-    @scale.anonymous
-    def body(W: int, H: int, output : [float], inputs: [[float]]) -> int:
-        for y in range(H):
+    @scale.anonymous(link=True)
+    def body(W: int, H: int, output: Out[[float]], inputs: In[[float]]) -> int:
+        for y in prange(H):
           for x in range(W):
             output[(y*W + x)] = { gen_tree(tree,x,y) }
         return 0
@@ -259,7 +251,6 @@ def compile_ir_image_wide(tree):
     output = q[name[output]]
 
     statements = []
-    cleanup = []
     temptoptr = {}
     def gen_tree(tree,x,y):
         if tree.kind == "const":
@@ -283,24 +274,20 @@ def compile_ir_image_wide(tree):
     for i, loop in enumerate(loopir):
         data = q[name[data]]
         if loop.kind == "storetemp":
-            ptr = q[malloc(W * H * 8)]
-            with q as cleanup_stmt:
-                _ = free(data)
-            cleanup.append(cleanup_stmt)
+            ptr = q[create_float_array(W * H)]
             temptoptr[loop] = data
         elif loop.kind == "storeresult":
             ptr = output
         with q as loopcode:
             data = ptr
-            for y in range(H):
+            for y in prange(H):
                 for x in range(W):
                     data[y*W+x] = u[gen_tree(loop.value,x,y)]
         statements.append(loopcode)
 
-    @scale.anonymous
-    def body(W: int, H: int, output: [float], inputs: [[float]]) -> int:
+    @scale.anonymous(link=True)
+    def body(W: int, H: int, output: Out[[float]], inputs: In[[float]]) -> int:
         {statements}
-        {cleanup}
         return 0
     return body
 
@@ -356,8 +343,8 @@ def compile_ir_blocked(tree):
                         start[y*W + x] = u[gen_tree(loop.value,x,y)]
         statements.append(loopcode)
 
-    @scale.anonymous
-    def body(W: int, H: int, output: [float], inputs: [[float]]):
+    @scale.anonymous(link=True)
+    def body(W: int, H: int, output: Out[[float]], inputs: In[[float]]):
         for beginy in range(0, {H}, {BLOCK_SIZE}):
             for beginx in range(0, {W}, {BLOCK_SIZE}):
                 {statements}
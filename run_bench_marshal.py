@@ -0,0 +1,2 @@
+import macropy.activate
+from bench_marshal import *
@@ -1,8 +1,35 @@
 from .compile import scale
 from . import quote
+from .executor import ProcessExecutor
+
+scale.ProcessExecutor = ProcessExecutor
 
 import ast as _ast
 
 goto = _ast.Name('goto', _ast.Load())
 label = _ast.Name('label', _ast.Load())
+prange = _ast.Name('prange', _ast.Load())
+
+
+float2 = _ast.Name('float2', _ast.Load())
+float4 = _ast.Name('float4', _ast.Load())
+float8 = _ast.Name('float8', _ast.Load())
+int4x = _ast.Name('int4x', _ast.Load())
+int8x = _ast.Name('int8x', _ast.Load())
+int16x = _ast.Name('int16x', _ast.Load())
+
+float32 = _ast.Name('float32', _ast.Load())
+int8 = _ast.Name('int8', _ast.Load())
+uint8 = _ast.Name('uint8', _ast.Load())
+int16 = _ast.Name('int16', _ast.Load())
+int64 = _ast.Name('int64', _ast.Load())
+
+
+class _Intent(_ast.Name):
+    # In[[float]] has to evaluate when the def runs; the annotation is read from the source
+    def __getitem__(self, typ):
+        return self
 
+In = _Intent('In', _ast.Load())
+Out = _Intent('Out', _ast.Load())
+InOut = _Intent('InOut', _ast.Load())
@@ -3,12 +3,21 @@ import functools
 
 import llvmlite.ir as llvm
 
-from .typechecker import TypeChecker
-from .irtypes import Uop, Bop, Cop, Ref, IntConst
+from .typechecker import NDArrayType, TypeChecker
+from .irtypes import Uop, Bop, Cop, Ref, Array, IntConst, Assign, BinOp, FuncCall, For, If, Label, Goto, Return
 
 
 class Backend(ast.NodeVisitor):
-    def __init__(self, name, global_vars):
+    counter_type = llvm.IntType(64)
+    # arrays of a constant size up to this many bytes go on the stack, others in the arena
+    stack_limit = 1 << 14
+    # block, capacity, used, bytes allocated past capacity, chain of those allocations and of
+    # arrays returned by calls
+    arena_type = llvm.LiteralStructType([llvm.IntType(8).as_pointer(), llvm.IntType(64), llvm.IntType(64),
+                                         llvm.IntType(64), llvm.IntType(8).as_pointer()])
+
+    def __init__(self, name, global_vars, instrument=False, num_threads=1, chunk_size=0,
+                 extern_counters=False):
         super(Backend, self).__init__()
         self.module = llvm.Module(name=name)
         self.builder = None
@@ -16,16 +25,88 @@ class Backend(ast.NodeVisitor):
         self.function_type = None
         self.global_vars = global_vars.copy()
         self.symbol_table = {}
+        # data pointer, shape and strides of each ndarray the body never rebinds, loaded on entry
+        self.arrays = {}
         self.label_table = {}
         self.unprocessed_gotos = {}
         self.prologue = None
+        self.instrument = instrument
+        self.extern_counters = extern_counters
+        self.counters = None
+        self.counter_names = []
+        self.counter_ids = {}
+        self.num_threads = num_threads
+        self.chunk_size = chunk_size
+        self.parallel = False
+        self.parallel_for = None
+        # the arena of the function being generated, and whether it is the module's own
+        self.arena = None
+        self.arena_runtime = None
 
     @staticmethod
-    def generate_llvm(func, global_vars):
-        visitor = Backend(func.name, global_vars)
+    def generate_llvm(func, global_vars, instrument=False, num_threads=1, chunk_size=0,
+                      extern_counters=False):
+        visitor = Backend(func.name, global_vars, instrument, num_threads, chunk_size, extern_counters)
         visitor.visit(func)
         return (visitor.module, visitor.function_type)
 
+    @staticmethod
+    def counters_name(name):
+        return name + '.counters'
+
+    @staticmethod
+    def passes_vectors(ftype):
+        return any(map(TypeChecker.is_vector, (ftype.return_type,) + tuple(ftype.args)))
+
+    @staticmethod
+    def ffi_name(name):
+        return name + '.ffi'
+
+    @staticmethod
+    def ffi_type(ftype):
+        # vectors cross into Python as pointers to their lanes, a vector result through a
+        # trailing pointer, since ctypes cannot pass them by value
+        args = [t.element.as_pointer() if TypeChecker.is_vector(t) else t for t in ftype.args]
+        ret = ftype.return_type
+        if TypeChecker.is_vector(ret):
+            args.append(ret.element.as_pointer())
+            ret = llvm.VoidType()
+        return llvm.FunctionType(ret, args)
+
+    @staticmethod
+    def alignment(typ):
+        # vectors are loaded from and stored to arrays aligned only to their elements
+        return max(Backend.width(typ) // 8, 1)
+
+    def declare_counters(self, node):
+        # one for the function entry, one per loop, two per branch and one per label
+        count = 1
+        for n in ast.walk(node):
+            if isinstance(n, If):
+                count += 2
+            elif isinstance(n, (For, Label)):
+                count += 1
+        typ = llvm.ArrayType(self.counter_type, count)
+        self.counters = llvm.GlobalVariable(self.module, typ, self.counters_name(node.name))
+        if not self.extern_counters:
+            # copies linked into other functions declare them only, and count into these
+            self.counters.initializer = llvm.Constant(typ, None)
+
+    def counter_id(self, kind):
+        self.counter_ids[kind] = self.counter_ids.get(kind, -1) + 1
+        return self.counter_ids[kind]
+
+    def count(self, name):
+        if self.counters is None:
+            return
+        index = len(self.counter_names)
+        self.counter_names.append(name)
+        ptr = self.builder.gep(self.counters, [self.const(0), self.const(index)])
+        if self.parallel:
+            self.builder.atomic_rmw('add', ptr, llvm.Constant(self.counter_type, 1), 'monotonic')
+            return
+        self.builder.store(self.builder.add(self.builder.load(ptr), llvm.Constant(self.counter_type, 1)), ptr)
+
     def visit_FuncDef(self, node):
         for name, typ in self.global_vars.items():
             if name != node.name:
@@ -39,15 +120,44 @@ class Backend(ast.NodeVisitor):
 
         prologue = self.func.append_basic_block()
         self.builder = llvm.IRBuilder(prologue)
+        if self.instrument:
+            self.declare_counters(node)
+            self.count('entry')
 
         args = self.func.args
         for name, arg in zip(node.args, args):
             self.symbol_table[name] = arg
+        self.add_intents(node)
+        self.load_arrays(node.args, node.body)
+        if self.uses_arena(node.body):
+            self.claim_arena()
         self.visit(node.body)
         self.builder.unreachable()
+        if self.passes_vectors(function_type):
+            self.ffi_wrapper()
+        # outlined loop bodies were added after it; callers expect the entry point last
+        self.module.globals.move_to_end(node.name)
 
         return self.func
 
+    def ffi_wrapper(self):
+        ftype = self.function_type
+        wrapper = llvm.Function(self.module, self.ffi_type(ftype), self.ffi_name(self.func.name))
+        builder = llvm.IRBuilder(wrapper.append_basic_block())
+        args = []
+        for typ, arg in zip(ftype.args, wrapper.args):
+            if TypeChecker.is_vector(typ):
+                arg = builder.load(builder.bitcast(arg, typ.as_pointer()), align=self.alignment(typ.element))
+            args.append(arg)
+        result = builder.call(self.func, args)
+        ret = ftype.return_type
+        if TypeChecker.is_vector(ret):
+            out = builder.bitcast(wrapper.args[-1], ret.as_pointer())
+            builder.store(result, out, align=self.alignment(ret.element))
+            builder.ret_void()
+        else:
+            builder.ret(result)
+
     def visit_Block(self, node):
         if not node.body:
             return
@@ -58,17 +168,249 @@ class Backend(ast.NodeVisitor):
             self.visit(b)
 
     def visit_FuncCall(self, node):
-        if node.name == "create_int_array" or node.name == "create_float_array" or node.name == "create_bool_array":
-            if len(node.args) == 1:
-                v = node.args[0]
-                if isinstance(v, IntConst):
-                    return self.builder.alloca(node.type.pointee, v.val)
-            raise NotImplementedError('creating array function takes in a single int constant')
+        if node.name in TypeChecker.array_constructors:
+            return self.create_array(node)
+        elif node.name in TypeChecker.vector_types:
+            return self.vector(node)
+        elif node.name == 'select':
+            cond, left, right = node.args
+            return self.builder.select(self.visit(cond),
+                                       self.convert(self.visit(left), left.type, node.type),
+                                       self.convert(self.visit(right), right.type, node.type))
         elif node.name in self.global_vars:
             node.args = list(map(self.visit, node.args))
-            return self.builder.call(self.global_vars[node.name], node.args)
+            result = self.builder.call(self.global_vars[node.name], node.args)
+            if getattr(node, 'adopt', False):
+                self.adopt(result)
+            return result
         raise NotImplementedError('function being called missing')
 
+    def on_stack(self, node):
+        size = node.args[0]
+        return isinstance(size, IntConst) and size.val * self.size_of(node.type.pointee) <= self.stack_limit
+
+    def in_arena(self, node):
+        if not isinstance(node, FuncCall):
+            return False
+        if node.name in TypeChecker.array_constructors:
+            return not getattr(node, 'owned', False) and not self.on_stack(node)
+        return getattr(node, 'adopt', False)
+
+    def uses_arena(self, body):
+        return any(map(self.in_arena, ast.walk(body)))
+
+    def create_array(self, node):
+        element = node.type.pointee
+        if getattr(node, 'owned', False):
+            return self.owned_array(node)
+        if self.on_stack(node):
+            # in the entry block, so arrays created in loops do not grow the stack
+            with self.builder.goto_entry_block():
+                return self.builder.alloca(element, node.args[0].val)
+        i64 = llvm.IntType(64)
+        size = self.builder.mul(self.convert(self.visit(node.args[0]), node.args[0].type, i64),
+                                llvm.Constant(i64, self.size_of(element)))
+        alloc, _, _ = self.arena_functions()
+        return self.builder.bitcast(self.builder.call(alloc, [self.arena[0], size]), node.type)
+
+    def owned_array(self, node):
+        # malloc'd behind a header of the element count and a link, for the arena that adopts
+        # it if it is returned to Scale code, or the NumPy array that owns it in Python
+        i64 = llvm.IntType(64)
+        count = self.convert(self.visit(node.args[0]), node.args[0].type, i64)
+        size = self.builder.add(self.builder.mul(count, llvm.Constant(i64, self.size_of(node.type.pointee))),
+                                llvm.Constant(i64, 16))
+        block = self.builder.call(self.arena_functions()[2], [size])
+        self.builder.store(count, self.builder.bitcast(block, i64.as_pointer()))
+        return self.builder.bitcast(self.builder.gep(block, [llvm.Constant(i64, 16)]), node.type)
+
+    def adopt(self, array):
+        i8p = llvm.IntType(8).as_pointer()
+        block = self.builder.gep(self.builder.bitcast(array, i8p), [llvm.Constant(llvm.IntType(64), -16)])
+        chain = self.builder.gep(self.arena[0], [self.const(0), self.const(4)])
+        self.builder.store(self.builder.load(chain), self.builder.bitcast(self.builder.gep(block, [self.const(8)]),
+                                                                          i8p.as_pointer()))
+        self.builder.store(block, chain)
+
+    def claim_arena(self):
+        # the module's arena is kept between calls; a call that finds it taken, by a recursive
+        # call or another thread, allocates from one of its own
+        _, _, _, arena, busy = self.arena_functions(globals=True)
+        local = self.local_arena()
+        claimed = self.builder.extract_value(
+            self.builder.cmpxchg(busy, self.const(0), self.const(1), 'acquire', 'monotonic'), 1)
+        self.arena = (self.builder.select(claimed, arena, local), claimed)
+
+    def local_arena(self):
+        with self.builder.goto_entry_block():
+            local = self.builder.alloca(self.arena_type)
+        self.builder.store(llvm.Constant(self.arena_type, None), local)
+        return local
+
+    def release_arena(self):
+        if self.arena is not None:
+            _, release, _ = self.arena_functions()
+            self.builder.call(release, list(self.arena))
+
+    def arena_functions(self, globals=False):
+        """
+        i8* arena_alloc(arena, size): bump allocation from the arena's block, falling back to
+        malloc once it is full. void arena_release(arena, keep): frees everything allocated
+        since; a kept arena grows its block to what the call used and is handed back.
+        """
+        if self.arena_runtime is None:
+            self.arena_runtime = self.build_arena_runtime()
+        return self.arena_runtime if globals else self.arena_runtime[:3]
+
+    def libc(self, name, ftype):
+        fn = self.module.globals.get(name)
+        if fn is None:
+            return llvm.Function(self.module, ftype, name)
+        # declared differently by a native function of the same name
+        return fn if fn.ftype == ftype else fn.bitcast(ftype.as_pointer())
+
+    def build_arena_runtime(self):
+        i1, i32, i64 = TypeChecker.bool_type, TypeChecker.int_type, llvm.IntType(64)
+        i8p = llvm.IntType(8).as_pointer()
+        null = llvm.Constant(i8p, None)
+        zero = llvm.Constant(i64, 0)
+        arena_ptr = self.arena_type.as_pointer()
+        malloc = self.libc('malloc', llvm.FunctionType(i8p, [i64]))
+        free = self.libc('free', llvm.FunctionType(llvm.VoidType(), [i8p]))
+        arena = llvm.GlobalVariable(self.module, self.arena_type, self.module.get_unique_name('scale.arena'))
+        arena.linkage = 'internal'
+        arena.initializer = llvm.Constant(self.arena_type, None)
+        busy = llvm.GlobalVariable(self.module, i32, self.module.get_unique_name('scale.arena.busy'))
+        busy.linkage = 'internal'
+        busy.initializer = self.const(0)
+        field = lambda b, a, k: b.gep(a, [self.const(0), self.const(k)])
+
+        alloc = llvm.Function(self.module, llvm.FunctionType(i8p, [arena_ptr, i64]),
+                              self.module.get_unique_name('scale.arena_alloc'))
+        alloc.linkage = 'internal'
+        a, size = alloc.args
+        b = llvm.IRBuilder(alloc.append_basic_block())
+        size = b.and_(b.add(size, llvm.Constant(i64, 15)), llvm.Constant(i64, ~15))
+        used = b.load(field(b, a, 2))
+        end = b.add(used, size)
+        bump, overflow = alloc.append_basic_block(), alloc.append_basic_block()
+        b.cbranch(b.icmp_unsigned('<=', end, b.load(field(b, a, 1))), bump, overflow)
+        b.position_at_end(bump)
+        b.store(end, field(b, a, 2))
+        b.ret(b.gep(b.load(field(b, a, 0)), [used]))
+        b.position_at_end(overflow)
+        # linked through the second half of a 16-byte header, to be freed on release
+        node = b.call(malloc, [b.add(size, llvm.Constant(i64, 16))])
+        b.store(b.load(field(b, a, 4)), b.bitcast(b.gep(node, [llvm.Constant(i64, 8)]), i8p.as_pointer()))
+        b.store(node, field(b, a, 4))
+        b.store(b.add(b.load(field(b, a, 3)), size), field(b, a, 3))
+        b.ret(b.gep(node, [llvm.Constant(i64, 16)]))
+
+        release = llvm.Function(self.module, llvm.FunctionType(llvm.VoidType(), [arena_ptr, i1]),
+                                self.module.get_unique_name('scale.arena_release'))
+        release.linkage = 'internal'
+        a, keep = release.args
+        entry, walk, freed, rest, resize, regrow, done, handback, finish = [
+            release.append_basic_block() for _ in range(9)]
+        b = llvm.IRBuilder(entry)
+        chain = b.load(field(b, a, 4))
+        b.branch(walk)
+        b.position_at_end(walk)
+        node = b.phi(i8p)
+        node.add_incoming(chain, entry)
+        b.cbranch(b.icmp_unsigned('==', node, null), rest, freed)
+        b.position_at_end(freed)
+        node.add_incoming(b.load(b.bitcast(b.gep(node, [llvm.Constant(i64, 8)]), i8p.as_pointer())), freed)
+        b.call(free, [node])
+        b.branch(walk)
+        b.position_at_end(rest)
+        b.store(null, field(b, a, 4))
+        b.store(zero, field(b, a, 2))
+        overflowed = b.load(field(b, a, 3))
+        grown = b.add(b.load(field(b, a, 1)), overflowed)
+        b.cbranch(b.or_(b.icmp_unsigned('!=', overflowed, zero), b.not_(keep)), resize, done)
+        b.position_at_end(resize)
+        b.call(free, [b.load(field(b, a, 0))])
+        b.store(null, field(b, a, 0))
+        b.store(zero, field(b, a, 1))
+        b.store(zero, field(b, a, 3))
+        b.cbranch(keep, regrow, done)
+        b.position_at_end(regrow)
+        block = b.call(malloc, [grown])
+        b.store(block, field(b, a, 0))
+        b.store(b.select(b.icmp_unsigned('==', block, null), zero, grown), field(b, a, 1))
+        b.branch(done)
+        b.position_at_end(done)
+        b.cbranch(keep, handback, finish)
+        b.position_at_end(handback)
+        # only the call that claimed the module's arena releases it with keep
+        b.store_atomic(self.const(0), busy, 'release', 4)
+        b.branch(finish)
+        b.position_at_end(finish)
+        b.ret_void()
+        return alloc, release, malloc, arena, busy
+
+    @staticmethod
+    def size_of(typ):
+        return max(Backend.width(typ) // 8, 1)
+
+    def vector(self, node):
+        vtype = node.type
+        if node.kind == 'load':
+            array, index = node.args
+            ptr = self.builder.gep(self.visit(array), [self.index(index)])
+            return self.builder.load(self.builder.bitcast(ptr, vtype.as_pointer()),
+                                     align=self.alignment(vtype.element))
+        if node.kind == 'splat':
+            return self.convert(self.visit(node.args[0]), node.args[0].type, vtype)
+        v = llvm.Constant(vtype, None)
+        for i, lane in enumerate(node.args):
+            v = self.builder.insert_element(v, self.convert(self.visit(lane), lane.type, vtype.element),
+                                            self.const(i))
+        return v
+
+    def convert(self, v, typ, to):
+        # typ is the type the checker gave v, which also says whether it is unsigned
+        if typ == to:
+            return v
+        if TypeChecker.is_vector(to) and not TypeChecker.is_vector(typ):
+            v = self.convert(v, typ, to.element)
+            splat = llvm.Constant(to, None)
+            for i in range(to.count):
+                splat = self.builder.insert_element(splat, v, self.const(i))
+            return splat
+        unsigned = TypeChecker.is_unsigned(typ) or TypeChecker.element_type(typ) == TypeChecker.bool_type
+        if TypeChecker.is_floating(to):
+            if not TypeChecker.is_floating(typ):
+                return (self.builder.uitofp if unsigned else self.builder.sitofp)(v, to)
+            if self.width(typ) < self.width(to):
+                return self.builder.fpext(v, to)
+            return self.builder.fptrunc(v, to) if self.width(typ) > self.width(to) else v
+        if TypeChecker.is_floating(typ):
+            return (self.builder.fptoui if TypeChecker.is_unsigned(to) else self.builder.fptosi)(v, to)
+        if self.width(typ) < self.width(to):
+            return (self.builder.zext if unsigned else self.builder.sext)(v, to)
+        if self.width(typ) > self.width(to):
+            return self.builder.trunc(v, to)
+        # int8 and uint8 are the same LLVM type
+        return v
+
+    @staticmethod
+    def width(typ):
+        typ = TypeChecker.element_type(typ)
+        if isinstance(typ, llvm.DoubleType):
+            return 64
+        if isinstance(typ, llvm.FloatType):
+            return 32
+        return typ.width
+
+    def index(self, node):
+        # gep reads indices as signed, so narrower and unsigned ones are widened first
+        v = self.visit(node)
+        if node.type == TypeChecker.int_type or node.type == TypeChecker.int64_type:
+            return v
+        return self.convert(v, node.type, TypeChecker.int_type)
+
     def visit_Array(self, node):
         ptr = self.builder.alloca(node.type.pointee, len(node.elts))
         for i in range(len(node.elts)):
@@ -87,15 +429,15 @@ class Backend(ast.NodeVisitor):
             raise NotImplementedError('bad type')
 
     def boolcast(self, v, orig_type):
-        if orig_type == TypeChecker.int_type:
+        if TypeChecker.is_integer(orig_type):
             return self.builder.select(
-                self.builder.icmp_signed('==', v, self.const(0)),
+                self.builder.icmp_signed('==', v, llvm.Constant(orig_type, 0)),
                 self.const(False),
                 self.const(True)
             )
-        elif orig_type == TypeChecker.float_type:
+        elif TypeChecker.is_floating(orig_type):
             return self.builder.select(
-                self.builder.fcmp_ordered('==', v, self.const(0.0)),
+                self.builder.fcmp_ordered('==', v, llvm.Constant(orig_type, 0.0)),
                 self.const(False),
                 self.const(True)
             )
@@ -116,10 +458,13 @@ class Backend(ast.NodeVisitor):
 
         op = None
         if node.op == Uop.Neg:
-            if node.type == TypeChecker.int_type:
+            v = self.convert(v, node.e.type, node.type)
+            if TypeChecker.is_integer(node.type):
                 op = self.builder.neg
             else:
-                op = functools.partial(self.builder.fmul, self.const(-1.0))
+                op = functools.partial(self.builder.fmul, llvm.Constant(node.type, -1.0))
+        elif TypeChecker.is_vector(node.type):
+            op = self.builder.not_
         else:
             def not_op(e):
                 bc = self.boolcast(e, node.e.type)
@@ -134,32 +479,30 @@ class Backend(ast.NodeVisitor):
 
         left = self.visit(node.left)
         right = self.visit(node.right)
-        if node.type == TypeChecker.float_type:
-            if node.left.type != TypeChecker.float_type:
-                left = self.builder.sitofp(left, TypeChecker.float_type)
-            if node.right.type != TypeChecker.float_type:
-                right = self.builder.sitofp(right, TypeChecker.float_type)
+        left = self.convert(left, node.left.type, node.type)
+        right = self.convert(right, node.right.type, node.type)
 
+        is_float = TypeChecker.is_floating(node.type)
         op = None
         if node.op == Bop.Add:
-            if node.type == TypeChecker.float_type:
+            if is_float:
                 op = self.builder.fadd
             else:
                 op = self.builder.add
         elif node.op == Bop.Sub:
-            if node.type == TypeChecker.float_type:
+            if is_float:
                 op = self.builder.fsub
             else:
                 op = self.builder.sub
         elif node.op == Bop.Mul:
-            if node.type == TypeChecker.float_type:
+            if is_float:
                 op = self.builder.fmul
             else:
                 op = self.builder.mul
         elif node.op == Bop.Div:
             op = self.builder.fdiv
         elif node.op == Bop.Mod:
-            if node.type == TypeChecker.float_type:
+            if is_float:
                 op = self.builder.frem
             else:
                 op = self.builder.srem
@@ -202,22 +545,79 @@ class Backend(ast.NodeVisitor):
         op = {Cop.EQ: '==', Cop.NE: '!=', Cop.LT: '<', Cop.GT: '>', Cop.LE: '<=', Cop.GE: '>='}[node.op]
         left = self.visit(node.left)
         right = self.visit(node.right)
-        if node.left.type == TypeChecker.float_type or node.right.type == TypeChecker.float_type:
-            if node.left.type != TypeChecker.float_type:
-                left = self.builder.sitofp(left, TypeChecker.float_type)
-            if node.right.type != TypeChecker.float_type:
-                right = self.builder.sitofp(right, TypeChecker.float_type)
+        typ = node.operand_type
+        left = self.convert(left, node.left.type, typ)
+        right = self.convert(right, node.right.type, typ)
+        if TypeChecker.is_floating(typ):
             cmp_ = self.builder.fcmp_ordered(op, left, right)
-        elif node.left.type == TypeChecker.int_type:
+        elif TypeChecker.is_integer(typ):
             cmp_ = self.builder.icmp_signed(op, left, right)
         else:
             cmp_ = self.builder.icmp_unsigned(op, left, right)
+        if TypeChecker.is_vector(node.type):
+            # lanewise, giving a mask for select
+            return cmp_
         return self.builder.select(cmp_, self.const(True), self.const(False))
 
+    def add_intents(self, node):
+        stored = {id(n.ref) for n in ast.walk(node.body) if isinstance(n, Assign)}
+        read = {n.name for n in ast.walk(node.body) if isinstance(n, Ref) and id(n) not in stored}
+        for name, arg in zip(node.args, self.func.args):
+            # ArgumentAttributes does not know these, though LLVM does
+            intent = TypeChecker.intent(arg.type)
+            if isinstance(arg.type, NDArrayType) or intent == 'In':
+                # the typechecker rejects stores to In arrays and passing them on as anything else
+                set.add(arg.attributes, 'readonly')
+            elif intent == 'Out' and name not in read and not isinstance(arg.type.pointee, llvm.PointerType):
+                set.add(arg.attributes, 'writeonly')
+
+    def load_arrays(self, names, body):
+        # branches and loops turn every name into a phi, so the cache goes by name
+        rebound = {n.ref.name for n in ast.walk(body) if isinstance(n, Assign) and n.ref.index is None}
+        for name in names:
+            desc = self.symbol_table[name]
+            if isinstance(desc.type, NDArrayType) and name not in rebound:
+                self.arrays[name] = self.array_fields(desc)
+
+    def array_fields(self, desc):
+        field = lambda *i: self.builder.load(self.builder.gep(desc, [self.const(0)] + [self.const(k) for k in i]))
+        ndim = desc.type.ndim
+        return (field(0), [field(1, k) for k in range(ndim)], [field(2, k) for k in range(ndim)])
+
+    def fields(self, name):
+        if name in self.arrays:
+            return self.arrays[name]
+        return self.array_fields(self.symbol_table[name])
+
+    def element_pointer(self, ref):
+        data, _, strides = self.fields(ref.name)
+        indices = ref.index.elts if isinstance(ref.index, Array) else [ref.index]
+        i64 = llvm.IntType(64)
+        offset = None
+        for i, stride in zip(indices, strides):
+            term = self.builder.mul(self.convert(self.visit(i), i.type, i64), stride)
+            offset = term if offset is None else self.builder.add(offset, term)
+        return self.builder.gep(data, [offset])
+
+    def visit_Shape(self, node):
+        _, shape, _ = self.fields(node.name)
+        if isinstance(node.dim, IntConst):
+            extent = shape[node.dim.val]
+        else:
+            dim = self.visit(node.dim)
+            extent = shape[0]
+            for k in range(1, len(shape)):
+                extent = self.builder.select(self.builder.icmp_signed('==', dim, self.const(k)), shape[k], extent)
+        return self.builder.trunc(extent, node.type)
+
     def visit_Ref(self, node):
         base = self.symbol_table[node.name]
         if node.index is None:
             return base
+        if isinstance(base.type, NDArrayType):
+            return self.builder.load(self.element_pointer(node))
+        if TypeChecker.is_vector(base.type):
+            return self.builder.extract_element(base, self.index(node.index))
         if isinstance(node.index.type, llvm.PointerType):
             ptr = self.symbol_table[node.name]
             for i in node.index.elts:
@@ -225,28 +625,21 @@ class Backend(ast.NodeVisitor):
                 ptr = self.builder.load(self.builder.gep(ptr, [a]))
             return ptr
 
-        index = self.visit(node.index)
-        ptr = self.builder.gep(self.symbol_table[node.name], [self.visit(node.index)])
+        ptr = self.builder.gep(self.symbol_table[node.name], [self.index(node.index)])
         return self.builder.load(ptr)
+
     def visit_CastToFloat(self, node):
-        if node.expr.type == TypeChecker.float_type:
-            return self.visit(node.expr)
-        else:
-            expr = self.visit(node.expr)
-            return self.builder.sitofp(expr, TypeChecker.float_type)
+        return self.convert(self.visit(node.expr), node.expr.type, node.type)
 
     def visit_CastToInt(self, node):
-        if node.expr.type == TypeChecker.float_type:
-            expr = self.visit(node.expr)
-            return self.builder.fptosi(expr, TypeChecker.int_type)
-        elif node.expr.type == TypeChecker.bool_type:
-            expr = self.visit(node.expr)
-            return self.builder.zext(expr, TypeChecker.int_type)
-        else:
-            return self.visit(node.expr)
+        return self.convert(self.visit(node.expr), node.expr.type, node.type)
+
+    def visit_Cast(self, node):
+        return self.convert(self.visit(node.expr), node.expr.type, node.type)
 
     def visit_Return(self, node):
         v = self.visit(node.val)
+        self.release_arena()
         self.builder.ret(v)
         block = self.func.append_basic_block()
         self.builder = llvm.IRBuilder(block)
@@ -256,14 +649,25 @@ class Backend(ast.NodeVisitor):
             if ref.index is None:
                 self.symbol_table[ref.name] = v
                 return
-            if isinstance(ref.index.type, llvm.PointerType):
+            base = self.symbol_table[ref.name]
+            if TypeChecker.is_vector(base.type):
+                self.symbol_table[ref.name] = self.builder.insert_element(base, v, self.index(ref.index))
+                return
+            if isinstance(base.type, NDArrayType):
+                ptr = self.element_pointer(ref)
+            elif isinstance(ref.index.type, llvm.PointerType):
                 ptr = self.symbol_table[ref.name]
                 for i in ref.index.elts:
                     prev = self.builder.gep(ptr, [self.visit(i)])
                     ptr = self.builder.load(prev)
                 self.builder.store(v, prev)
                 return
-            ptr = self.builder.gep(self.symbol_table[ref.name], [self.visit(ref.index)])
+            else:
+                ptr = self.builder.gep(self.symbol_table[ref.name], [self.index(ref.index)])
+            if TypeChecker.is_vector(vtype):
+                ptr = self.builder.bitcast(ptr, vtype.as_pointer())
+                self.builder.store(v, ptr, align=self.alignment(vtype.element))
+                return
             self.builder.store(v, ptr)
 
         else:
@@ -283,8 +687,10 @@ class Backend(ast.NodeVisitor):
         self.builder.cbranch(cond, iblock, eblock)
 
         old_symbols = self.symbol_table.copy()
+        branch = self.counter_id('if')
 
         self.builder = llvm.IRBuilder(iblock)
+        self.count('if {} then'.format(branch))
         self.visit(node.body)
         iblock = self.builder.block
         self.builder.branch(jblock)
@@ -293,6 +699,7 @@ class Backend(ast.NodeVisitor):
         self.symbol_table = old_symbols.copy()
 
         self.builder = llvm.IRBuilder(eblock)
+        self.count('if {} else'.format(branch))
         if node.else_body:
             self.visit(node.else_body)
             eblock = self.builder.block
@@ -313,14 +720,14 @@ class Backend(ast.NodeVisitor):
             if s in else_sk:
                 phi.add_incoming(else_symbols[s], eblock)
             else:
-                phi.add_incoming(llvm.Constant(typ, 0), eblock)
+                phi.add_incoming(llvm.Constant(typ, None), eblock)
             self.symbol_table[s] = phi
         else_sk = else_sk.difference(if_sk)
         for s in else_sk:
             typ = else_symbols[s].type
             phi = self.builder.phi(typ)
             phi.add_incoming(else_symbols[s], eblock)
-            phi.add_incoming(llvm.Constant(typ, 0), iblock)
+            phi.add_incoming(llvm.Constant(typ, None), iblock)
 
     def visit_For(self, node):
         bblock = self.func.append_basic_block()
@@ -346,6 +753,7 @@ class Backend(ast.NodeVisitor):
 
         self.builder = llvm.IRBuilder(iblock)
         old_symbols = self.symbol_table.copy()
+        self.count('for {} ({})'.format(self.counter_id('for'), node.var))
         self.visit(node.body)
         new_iblock = self.builder.block
         self.assign(ref, self.builder.add(self.visit(ref), llvm.Constant(TypeChecker.int_type, 1)), TypeChecker.int_type)
@@ -365,7 +773,7 @@ class Backend(ast.NodeVisitor):
                 typ = self.symbol_table[k].type
                 phi = self.builder.phi(typ)
                 phi.add_incoming(self.symbol_table[k], new_iblock)
-                phi.add_incoming(llvm.Constant(typ, 0), bblock)
+                phi.add_incoming(llvm.Constant(typ, None), bblock)
                 self.symbol_table[k] = phi
 
         vref = self.visit(ref)
@@ -374,6 +782,203 @@ class Backend(ast.NodeVisitor):
 
         self.builder = llvm.IRBuilder(jblock)
 
+    def find_reductions(self, node):
+        # outer scalars updated as v = v + e, v = v - e or v = v * e, and not read otherwise
+        ops = {}
+        for n in ast.walk(node.body):
+            if not isinstance(n, Assign) or n.ref.index is not None:
+                continue
+            name = n.ref.name
+            if name not in self.symbol_table or name == node.var:
+                continue
+            val = n.val
+            if (isinstance(val, BinOp) and isinstance(val.left, Ref) and val.left.name == name
+                    and val.left.index is None and val.op in (Bop.Add, Bop.Sub, Bop.Mul)):
+                op = Bop.Mul if val.op == Bop.Mul else Bop.Add
+                if ops.setdefault(name, op) != op:
+                    raise NotImplementedError('{} mixes + and * reductions'.format(name))
+            else:
+                ops[name] = None
+        reductions = {}
+        for name, op in ops.items():
+            if op is None:
+                continue
+            uses = sum(1 for n in ast.walk(node.body) if isinstance(n, Ref) and n.name == name)
+            updates = sum(1 for n in ast.walk(node.body) if isinstance(n, Assign) and n.ref.name == name)
+            if uses == 2 * updates:
+                reductions[name] = op
+        return reductions
+
+    def identity(self, op, typ):
+        return llvm.Constant(typ, 1 if op == Bop.Mul else 0)
+
+    def combine(self, op, typ, a, b):
+        if TypeChecker.is_floating(typ):
+            return (self.builder.fmul if op == Bop.Mul else self.builder.fadd)(a, b)
+        return (self.builder.mul if op == Bop.Mul else self.builder.add)(a, b)
+
+    def parallel_runtime(self):
+        """
+        void parallel_for(body, env, lo, hi): runs body(env, start, end, tid) over chunks of
+        [lo, hi) on num_threads pthreads, which take chunks from a shared atomic counter.
+        """
+        if self.parallel_for is not None:
+            return self.parallel_for
+        i32 = TypeChecker.int_type
+        i64 = llvm.IntType(64)
+        i8p = llvm.IntType(8).as_pointer()
+        body_type = llvm.FunctionType(llvm.VoidType(), [i8p, i32, i32, i32]).as_pointer()
+        task_type = llvm.LiteralStructType([body_type, i8p, i32.as_pointer(), i32, i32, i32])
+        start_type = llvm.FunctionType(i8p, [i8p])
+        create = self.module.globals.get('pthread_create') or llvm.Function(
+            self.module, llvm.FunctionType(i32, [i64.as_pointer(), i8p, start_type.as_pointer(), i8p]),
+            'pthread_create')
+        join = self.module.globals.get('pthread_join') or llvm.Function(
+            self.module, llvm.FunctionType(i32, [i64, i8p.as_pointer()]), 'pthread_join')
+
+        worker = llvm.Function(self.module, start_type, self.module.get_unique_name('scale.parallel_worker'))
+        worker.linkage = 'internal'
+        b = llvm.IRBuilder(worker.append_basic_block())
+        task = b.bitcast(worker.args[0], task_type.as_pointer())
+        body, env, counter, hi, chunk, tid = [b.load(b.gep(task, [self.const(0), self.const(k)]))
+                                              for k in range(6)]
+        loop, work, done = [worker.append_basic_block() for _ in range(3)]
+        b.branch(loop)
+        b.position_at_end(loop)
+        start = b.atomic_rmw('add', counter, chunk, 'monotonic')
+        b.cbranch(b.icmp_signed('<', start, hi), work, done)
+        b.position_at_end(work)
+        end = b.add(start, chunk)
+        b.call(body, [env, start, b.select(b.icmp_signed('<', end, hi), end, hi), tid])
+        b.branch(loop)
+        b.position_at_end(done)
+        b.ret(llvm.Constant(i8p, None))
+
+        n = self.num_threads
+        driver = llvm.Function(self.module, llvm.FunctionType(llvm.VoidType(), [body_type, i8p, i32, i32]),
+                               self.module.get_unique_name('scale.parallel_for'))
+        driver.linkage = 'internal'
+        body, env, lo, hi = driver.args
+        b = llvm.IRBuilder(driver.append_basic_block())
+        total = b.sub(hi, lo)
+        if self.chunk_size > 0:
+            chunk = self.const(self.chunk_size)
+        else:
+            # about four chunks per thread balances load without much contention on the counter
+            chunk = b.sdiv(b.add(total, self.const(4 * n - 1)), self.const(4 * n))
+            chunk = b.select(b.icmp_signed('<', chunk, self.const(1)), self.const(1), chunk)
+        serial, threaded = driver.append_basic_block(), driver.append_basic_block()
+        b.cbranch(b.icmp_signed('<=', total, chunk), serial, threaded)
+        b.position_at_end(serial)
+        b.call(body, [env, lo, hi, self.const(0)])
+        b.ret_void()
+
+        b.position_at_end(threaded)
+        counter = b.alloca(i32)
+        b.store(lo, counter)
+        tasks = b.alloca(task_type, n)
+        threads = b.alloca(i64, n)
+        for t in range(n):
+            task = b.gep(tasks, [self.const(t)])
+            for k, v in enumerate([body, env, counter, hi, chunk, self.const(t)]):
+                b.store(v, b.gep(task, [self.const(0), self.const(k)]))
+        started = [b.icmp_signed('==', self.const(0), b.call(create, [
+            b.gep(threads, [self.const(t)]), llvm.Constant(i8p, None), worker,
+            b.bitcast(b.gep(tasks, [self.const(t)]), i8p)])) for t in range(1, n)]
+        # the calling thread takes part too
+        b.call(worker, [b.bitcast(tasks, i8p)])
+        for t, ok in zip(range(1, n), started):
+            joined, after = driver.append_basic_block(), driver.append_basic_block()
+            b.cbranch(ok, joined, after)
+            b.position_at_end(joined)
+            b.call(join, [b.load(b.gep(threads, [self.const(t)])), llvm.Constant(i8p.as_pointer(), None)])
+            b.branch(after)
+            b.position_at_end(after)
+        b.ret_void()
+
+        self.parallel_for = driver
+        return driver
+
+    def outline_loop(self, node, captured, reductions, env_type):
+        saved = self.func, self.builder, self.symbol_table, self.arrays, self.arena
+        i32 = TypeChecker.int_type
+        types = {name: self.symbol_table[name].type for name in list(captured) + list(reductions)}
+        fn_type = llvm.FunctionType(llvm.VoidType(), [llvm.IntType(8).as_pointer(), i32, i32, i32])
+        name = '{}.prange{}'.format(self.func.name, self.counter_id('prange'))
+        self.func = llvm.Function(self.module, fn_type, name)
+        self.func.linkage = 'internal'
+        env_arg, lo, hi, tid = self.func.args
+        self.builder = llvm.IRBuilder(self.func.append_basic_block())
+        self.parallel = True
+        env = self.builder.bitcast(env_arg, llvm.PointerType(env_type))
+        self.symbol_table = {'.lo': lo, '.hi': hi}
+        self.arrays = {}
+        for k, name in enumerate(captured):
+            self.symbol_table[name] = self.builder.load(self.builder.gep(env, [self.const(0), self.const(k)]))
+        self.load_arrays(captured, node.body)
+        # each chunk allocates from an arena of its own, released when it is done
+        self.arena = (self.local_arena(), self.const(False)) if self.uses_arena(node.body) else None
+        for name, op in reductions.items():
+            self.symbol_table[name] = self.identity(op, types[name])
+
+        self.visit_For(For(var=node.var, min=Ref('.lo'), max=Ref('.hi'), body=node.body))
+
+        # fold this chunk into the thread's partial result; each thread owns its slot
+        for k, (name, op) in enumerate(sorted(reductions.items())):
+            partials = self.builder.load(self.builder.gep(env, [self.const(0), self.const(len(captured) + k)]))
+            slot = self.builder.gep(partials, [tid])
+            self.builder.store(self.combine(op, types[name], self.builder.load(slot), self.symbol_table[name]), slot)
+        self.release_arena()
+        self.builder.ret_void()
+
+        outlined = self.func
+        self.func, self.builder, self.symbol_table, self.arrays, self.arena = saved
+        self.parallel = False
+        return outlined
+
+    def visit_ParallelFor(self, node):
+        if self.parallel or self.num_threads <= 1:
+            # nested parallel loops run their iterations on the thread that reaches them
+            return self.visit_For(node)
+        for n in ast.walk(node.body):
+            if isinstance(n, (Return, Label, Goto)):
+                raise NotImplementedError('prange loops cannot contain return, label or goto')
+        reductions = self.find_reductions(node)
+        used = {n.name for n in ast.walk(node.body) if isinstance(n, Ref)}
+        captured = sorted(name for name in used
+                          if name in self.symbol_table and name not in reductions and name != node.var)
+        names = sorted(reductions)
+        env_type = llvm.LiteralStructType([self.symbol_table[name].type for name in captured] +
+                                          [self.symbol_table[name].type.as_pointer() for name in names])
+        body = self.outline_loop(node, captured, reductions, env_type)
+
+        lo = self.visit(node.min)
+        hi = self.visit(node.max)
+        with self.builder.goto_entry_block():
+            env = self.builder.alloca(env_type)
+            partials = {name: self.builder.alloca(llvm.ArrayType(self.symbol_table[name].type, self.num_threads))
+                        for name in names}
+        for k, name in enumerate(captured):
+            self.builder.store(self.symbol_table[name], self.builder.gep(env, [self.const(0), self.const(k)]))
+        for k, name in enumerate(names):
+            typ = self.symbol_table[name].type
+            array_type = llvm.ArrayType(typ, self.num_threads)
+            self.builder.store(llvm.Constant(array_type, [self.identity(reductions[name], typ)] * self.num_threads),
+                               partials[name])
+            self.builder.store(self.builder.gep(partials[name], [self.const(0), self.const(0)]),
+                               self.builder.gep(env, [self.const(0), self.const(len(captured) + k)]))
+        self.builder.call(self.parallel_runtime(),
+                          [body, self.builder.bitcast(env, llvm.IntType(8).as_pointer()), lo, hi])
+        # the loop variable ends where the serial loop leaves it
+        self.symbol_table[node.var] = self.builder.select(self.builder.icmp_signed('<', lo, hi), hi, lo)
+        for name in names:
+            typ = self.symbol_table[name].type
+            value = self.symbol_table[name]
+            for t in range(self.num_threads):
+                partial = self.builder.load(self.builder.gep(partials[name], [self.const(0), self.const(t)]))
+                value = self.combine(reductions[name], typ, value, partial)
+            self.symbol_table[name] = value
+
     def generic_visit(self, node):
         raise NotImplementedError
 
@@ -390,6 +995,7 @@ class Backend(ast.NodeVisitor):
         for k, v in list(self.symbol_table.items()):
             self.symbol_table[k] = self.builder.phi(v.type)
             self.symbol_table[k].add_incoming(old_block, v)
+        self.count('label {}'.format(node.name))
         self.label_table[node.name] = (self.builder.block, self.symbol_table.copy())
         if node.name in self.unprocessed_gotos:
             for src, st in self.unprocessed_gotos[node.name]:
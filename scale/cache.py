@@ -0,0 +1,137 @@
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+
+import llvmlite
+
+# bump whenever the layout of cache entries changes; changes to the generated code are
+# covered by source_hash()
+FORMAT_VERSION = 2
+
+
+@functools.lru_cache()
+def source_hash():
+    # the generated code, its ABI included, follows from the compiler's own sources, so
+    # entries written by any other version of them are never loaded
+    h = hashlib.sha256()
+    package = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(package)):
+        if name.endswith('.py'):
+            with open(os.path.join(package, name), 'rb') as f:
+                h.update(name.encode('utf-8') + b'\0' + f.read() + b'\0')
+    return h.hexdigest()
+
+
+class ObjectCache(object):
+    """
+    Content-addressed on-disk cache of object code for compiled Scale functions.
+    Entries are evicted least-recently-used first once the cache grows past max_size bytes.
+    """
+    def __init__(self, path=None, max_size=256 * 1024 * 1024):
+        if path is None:
+            path = os.environ.get('SCALE_CACHE_DIR',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'scale'))
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha256()
+        for part in (FORMAT_VERSION, source_hash(), llvmlite.__version__) + parts:
+            h.update(repr(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + '.scale')
+
+    def load(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            if entry.get('key') != key:
+                raise ValueError('cache entry does not match its key')
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # truncated or foreign file; drop it and recompile
+            self.discard(key)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def store(self, key, entry):
+        entry = dict(entry, key=key)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.entry_path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def discard(self, key):
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.scale'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, name in self.entries():
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries()),
+            'size': self.size(),
+        }
@@ -1,69 +1,201 @@
 import ast
+import collections
+import concurrent.futures
 import contextlib
+import copy
 import ctypes
 import functools
 import inspect
+import itertools
+import os
+import struct
+import sys
+import threading
+import time
+import typing
+import weakref
 
+import numpy
 from llvmlite import ir as llvm
 import llvmlite.binding as binding
 
 from .backend import Backend
-from .escape import ProcessEscape, SubexprVisitor
+from .cache import ObjectCache
+from .escape import ProcessEscape, SubexprVisitor, to_ast
 from .frontend import Frontend
-from .interpreter import Interpreter
-from .marshalling import MarshalledArg
-from .typechecker import TypeChecker
+from .interpreter import InterpretedFunction
+from .jit import CodeSpace, JITModule
+from .marshalling import MarshalledArg, NativeFunction, VectorFunction
+from .stats import CompileStats, count_instructions, count_nodes, machine_code_size
+from .typechecker import TypeChecker, LLVMTypeBuilder
 
+# registries shared by every thread; writes happen under _compile_lock, which is only held
+# while publishing, never across a compile
 global_vars = {}
-anon_id = 0
+_anon_ids = itertools.count()
+_compile_hooks = []
+_compile_lock = threading.RLock()
+# compiles of one function are serialized by its own compile_lock; compile_all takes several
+# of those at once, so two of them must not interleave
+_compile_all_lock = threading.Lock()
+object_cache = ObjectCache() if 'SCALE_CACHE_DIR' in os.environ else None
+code_space = CodeSpace()
+
+# held while a function is compiled to Python, apart from compiles so the interpreted tier
+# never waits on one
+_interpret_lock = threading.RLock()
+
+_thread_state = threading.local()
+
+# inliner threshold for linked modules when none is given; LLVM's own at -O3
+# (OptAggressiveThreshold). Without one the pass manager builder adds no inliner at all.
+LINKED_INLINE_THRESHOLD = 250
+_parsed_functions = weakref.WeakKeyDictionary()
 
 @functools.lru_cache()
-def get_jit_engine():
+def _initialize_llvm():
     binding.initialize()
     binding.initialize_native_target()
     binding.initialize_native_asmprinter()
 
-    target = binding.Target.from_default_triple()
-    target_machine = target.create_target_machine()
+def codegen_options(cpu=None, features=None, opt_level=3, vectorize=False, unroll=True,
+                    inline_threshold=None, size_level=0, link=False, instrument=False,
+                    num_threads=None, chunk_size=0):
+    _initialize_llvm()
+    if cpu == 'host':
+        cpu = binding.get_host_cpu_name()
+        if features is None:
+            features = 'host'
+    if features == 'host':
+        features = binding.get_host_cpu_features().flatten()
+    return {
+        'cpu': cpu or '',
+        'features': features or '',
+        'opt_level': opt_level,
+        'vectorize': vectorize,
+        'unroll': unroll,
+        'inline_threshold': inline_threshold,
+        'size_level': size_level,
+        'link': link,
+        'instrument': instrument,
+        # prange loops are compiled for a fixed number of threads
+        'num_threads': num_threads or int(os.environ.get('SCALE_NUM_THREADS', 0)) or os.cpu_count() or 1,
+        'chunk_size': chunk_size,
+    }
+
+def get_target_machine(options=None):
+    options = options or codegen_options()
+    key = (options['cpu'], options['features'], min(options['opt_level'], 3))
+    # target machines are not safe to share between threads compiling concurrently
+    target_machines = getattr(_thread_state, 'target_machines', None)
+    if target_machines is None:
+        target_machines = _thread_state.target_machines = {}
+    if key not in target_machines:
+        _initialize_llvm()
+        target = binding.Target.from_default_triple()
+        target_machines[key] = target.create_target_machine(cpu=key[0], features=key[1], opt=key[2])
+    return target_machines[key]
+
+def create_jit_engine():
+    _initialize_llvm()
+    # the engine takes ownership of its target machine, so it gets its own
+    target_machine = binding.Target.from_default_triple().create_target_machine()
     backing_module = binding.parse_assembly("")
     return binding.create_mcjit_compiler(backing_module, target_machine)
 
-def assemble(module):
+@functools.lru_cache()
+def get_jit_engine():
+    return create_jit_engine()
+
+def assemble(module, options=None, linked=(), stats=None):
+    options = options or codegen_options()
+    stats = stats or CompileStats(None)
+    target_machine = get_target_machine(options)
     opt = binding.ModulePassManager()
+    # target-specific cost models for the vectorizers and the inliner
+    target_machine.add_analysis_passes(opt)
     builder = binding.PassManagerBuilder()
-    builder.opt_level = 3
+    builder.opt_level = options['opt_level']
+    builder.size_level = options['size_level']
+    builder.loop_vectorize = options['vectorize']
+    builder.slp_vectorize = options['vectorize']
+    builder.disable_unroll_loops = not options['unroll']
+    inline_threshold = options['inline_threshold']
+    if inline_threshold is None and linked:
+        inline_threshold = LINKED_INLINE_THRESHOLD
+    if inline_threshold is not None:
+        builder.inlining_threshold = inline_threshold
     builder.populate(opt)
-    mod = binding.parse_assembly(str(module))
-    mod.verify()
-    opt.run(mod)
+    # a fresh context per module lets independent functions be optimized in parallel
+    with stats.time('parse'):
+        context = binding.create_context()
+        mod = binding.parse_assembly(str(module), context=context)
+        if linked:
+            # pull in callee definitions so calls across Scale functions can be inlined;
+            # the copies are internal, which also lets globalopt switch them to fastcc
+            exported = module.functions[-1].name
+            for other in linked:
+                mod.link_in(binding.parse_assembly(str(other), context=context))
+            exported = (exported, Backend.ffi_name(exported))
+            for fn in mod.functions:
+                if not fn.is_declaration and fn.name not in exported:
+                    fn.linkage = binding.Linkage.internal
+        mod.triple = target_machine.triple
+        mod.data_layout = str(target_machine.target_data)
+        mod.verify()
+    stats.counts['llvm_instructions_before'] = count_instructions(mod)
+    with stats.time('optimize'):
+        opt.run(mod)
+    stats.counts['llvm_instructions_after'] = count_instructions(mod)
     return mod
 
-def register_module(llvm_mod, dump_llvm=False):
-    # assert len(llvm_mod.functions) == 1
+def emit_object(native_mod, options=None):
+    return get_target_machine(options).emit_object(native_mod)
+
+def describe_options(options):
+    return '; ' + ' '.join('{}={}'.format(k, options[k]) for k in sorted(options)) + '\n'
+
+def load_object(obj, name):
     engine = get_jit_engine()
-    native_mod = assemble(llvm_mod)
-    if dump_llvm:
-        print(native_mod)
-    engine.add_module(native_mod)
+    engine.add_object_file(binding.ObjectFileRef.from_data(obj))
     engine.finalize_object()
-    return engine.get_function_address(llvm_mod.functions[-1].name), native_mod
-
-def run_marshalled(func, func_ptr, *args):
-    # Gather argument types
-    arg_types = [arg.type for arg in func.args]
-
-    # Create signature
-    ret_type = MarshalledArg.to_ctype(func.return_value.type)
-    arg_ctypes = [MarshalledArg.to_ctype(arg) for arg in arg_types]
-    cfunc = ctypes.CFUNCTYPE(ret_type, *arg_ctypes)(func_ptr)
-
-    # Call the function
-    with contextlib.ExitStack() as stack:
-        func_args = [stack.enter_context(MarshalledArg(arg, ty)) for arg, ty in zip(args, arg_types)]
-        value = cfunc(*func_args)
-        if ret_type == ctypes.c_char:
-            value = value == b'\x01'
-        return value
+    address = engine.get_function_address(name)
+    # anonymous functions live in engines of their own and find named ones through this
+    binding.add_symbol(name, address)
+    return address
+
+def cache_key(unescaped, deps, options, linked=()):
+    target_machine = get_target_machine(options)
+    signatures = tuple((dep, str(global_vars.get(dep))) for dep in sorted(deps))
+    bodies = tuple(sorted((job.name, ast.dump(job.unescaped)) for job in linked))
+    return object_cache.key(ast.dump(unescaped), signatures, bodies, sorted(options.items()),
+                            target_machine.triple)
+
+def _signature(node):
+    type_builder = LLVMTypeBuilder()
+    args = tuple(type_builder.visit(arg.annotation) for arg in node.args.args)
+    return llvm.FunctionType(type_builder.visit(node.returns), args)
+
+def _generate(unescaped, options=None, extern_counters=False):
+    options = options or codegen_options()
+    func = Frontend().visit(unescaped)
+    with _compile_lock:
+        signatures = dict(global_vars)
+    TypeChecker.analyze(func, signatures)
+    llvm_mod, ftype = Backend.generate_llvm(func, signatures, options['instrument'],
+                                            options['num_threads'], options['chunk_size'],
+                                            extern_counters)
+    return func, llvm_mod, ftype
+
+def _entry_name(name, ftype):
+    # functions passing vectors are called from Python through their wrapper
+    return Backend.ffi_name(name) if Backend.passes_vectors(ftype) else name
+
+def _native_function(name, ftype, func_ptr):
+    if Backend.passes_vectors(ftype):
+        wrapper = llvm.Function(llvm.Module(name=name), Backend.ffi_type(ftype), Backend.ffi_name(name))
+        return VectorFunction(ftype, wrapper, func_ptr)
+    return NativeFunction(llvm.Function(llvm.Module(name=name), ftype, name), func_ptr)
 
 class _FuncCallExtractor(SubexprVisitor):
     def __init__(self):
@@ -75,66 +207,172 @@ class _FuncCallExtractor(SubexprVisitor):
             'create_int_array',
             'create_float_array',
             'create_bool_array',
-            'range'
-        ))
+            'range',
+            'prange',
+            'select',
+        )) | set(TypeChecker.scalar_types) | set(TypeChecker.vector_types)
         if node.func.id not in blacklist:
             self.calls.add(node.func.id)
         return node
 
-def _scale(f, *, lazy=True, generate_llvm=True, dump_unescaped=False, dump_ir=False,
-         dump_llvm=False, dump_opt=False, anonymous=False, depth=1):
-    # get caller's globals and locals for escape evaluation
-    _globals = inspect.stack()[depth][0].f_globals
-    _locals = inspect.stack()[depth][0].f_locals
-    params = inspect.getfullargspec(f)[0]
-    source = inspect.getsource(f)
-    base_indent = len(source) - len(source.lstrip())
-    lines = map(lambda _: _[base_indent:], source.split('\n'))
-    source = '\n'.join(lines).strip()
-    parse_tree = ast.parse(source).body[0]
-    unescaped = ProcessEscape(params, _globals, _locals).visit(parse_tree)
+class _CompileJob(object):
+    """
+    The stages of compiling one escaped Scale function. generate() must run in dependency
+    order since it publishes the function's signature; optimize() can run concurrently.
+    """
+    def __init__(self, f, unescaped, params, deps, _globals, _locals, options, stats,
+                 anonymous=False, dump_ir=False, dump_llvm=False, dump_opt=False, name=None):
+        self.f = f
+        self.name = name or f.__name__
+        self.unescaped = unescaped
+        self.params = params
+        self.deps = deps
+        self.globals = _globals
+        self.locals = _locals
+        self.options = options
+        self.stats = stats
+        self.anonymous = anonymous
+        self.dump_ir = dump_ir
+        self.dump_llvm = dump_llvm
+        self.dump_opt = dump_opt
+        self.key = None
+        self.entry = None
+        self.func = None
+        self.llvm_mod = None
+        self.counter_names = []
+        self.linked = []
+        self.linked_modules = []
+        self.interpreted = None
 
-    if dump_unescaped:
-        import astunparse
-        processed_src = astunparse.unparse(unescaped.body).strip()
-        header_src = 'def ___{}_inner({}):\n{}'.format(
-                f.__name__,
-                ', '.join(params),
-                '\n'.join(map(lambda x: '\t' + x, processed_src.split('\n'))))
-        print(header_src)
+    def dependencies(self):
+        for dep in self.deps:
+            if dep != self.name:
+                yield eval(dep, self.globals, self.locals)
 
-    global_name = f.__name__
-    extract = _FuncCallExtractor()
-    extract.visit(unescaped)
-    deps = extract.calls
+    def compile_deps(self, deferred=()):
+        for dp in self.dependencies():
+            if dp not in deferred:
+                _ensure_compiled(dp)
 
-    if lazy:
-        yield
+    def linked_jobs(self):
+        seen = set([self.name])
+        jobs = []
+        stack = list(self.dependencies())
+        while stack:
+            job = getattr(stack.pop(), 'job', None)
+            if job is None or job.anonymous or job.name in seen:
+                continue
+            seen.add(job.name)
+            jobs.append(job)
+            stack.extend(job.dependencies())
+        return jobs
 
-    for dep in deps:
-        dp = eval(dep, _globals, _locals)
-        if dep != f.__name__ and not dp.is_compiled:
-            dp.compile()
+    def llvm_module(self):
+        # the copy linked into callers; dropped once the object code is emitted, and
+        # regenerated rather than kept again. An instrumented copy counts into this
+        # function's own counters instead of defining a second set.
+        llvm_mod = self.llvm_mod
+        if llvm_mod is None or self.counter_names:
+            llvm_mod = _generate(self.unescaped, self.options, extern_counters=True)[1]
+        return llvm_mod
 
-    if generate_llvm:
-        func = Frontend().visit(unescaped)
-        TypeChecker.analyze(func, global_vars)
-        if dump_ir:
-            import astor
-            print(astor.dump_tree(func))
+    def generate(self):
+        if self.options['link']:
+            self.linked = self.linked_jobs()
+        stats = self.stats
+        if object_cache is not None:
+            with stats.time('cache'):
+                self.key = cache_key(self.unescaped, self.deps, self.options, self.linked)
+                self.entry = object_cache.load(self.key)
+        stats.counts['cache_hit'] = self.entry is not None
+
+        if self.entry is None:
+            with stats.time('frontend'):
+                self.func = Frontend().visit(self.unescaped)
+            stats.counts['ir_nodes'] = count_nodes(self.func)
+            with _compile_lock:
+                signatures = dict(global_vars)
+            with stats.time('typecheck'):
+                TypeChecker.analyze(self.func, signatures)
+            if self.dump_ir:
+                import astor
+                print(astor.dump_tree(self.func))
+
+            with stats.time('backend'):
+                backend = Backend(self.func.name, signatures, self.options['instrument'],
+                                  self.options['num_threads'], self.options['chunk_size'])
+                backend.visit(self.func)
+                self.llvm_mod, self.ftype = backend.module, backend.function_type
+                self.counter_names = backend.counter_names
+            if self.dump_llvm:
+                print(str(self.llvm_mod))
+            self.linked_modules = [job.llvm_module() for job in self.linked]
+        else:
+            # warm start: the signature is all that is needed to call into the cached code
+            self.ftype = _signature(self.unescaped)
+            self.counter_names = self.entry.get('counters', [])
+
+        if not self.anonymous:
+            with _compile_lock:
+                global_vars[self.name] = self.ftype
 
-        llvm_mod, ftype = Backend.generate_llvm(func, global_vars)
-        if not anonymous:
-            global_vars[global_name] = ftype
-        if dump_llvm:
-            print(str(llvm_mod))
+    def optimize(self):
+        if self.entry is not None:
+            return
+        native_mod = assemble(self.llvm_mod, self.options, self.linked_modules, self.stats)
+        if self.dump_opt:
+            print(native_mod)
+        with self.stats.time('codegen'):
+            obj = emit_object(native_mod, self.options)
+        entry = {
+            'object': obj,
+            'opcode': describe_options(self.options) + str(''.join(map(str, native_mod.functions))),
+            'counters': self.counter_names,
+        }
+        if self.key is not None:
+            with self.stats.time('cache'):
+                object_cache.store(self.key, entry)
+        self.entry = entry
+        # from here on only the object code is needed
+        self.func = None
+        self.llvm_mod = None
+        self.linked_modules = []
 
-        func_ptr, opcode = register_module(llvm_mod, dump_opt)
+    def finish(self):
+        entry_name = _entry_name(self.name, self.ftype)
+        with self.stats.time('load'):
+            if self.anonymous:
+                jit_module = JITModule(self.entry['object'], entry_name, create_jit_engine, code_space)
+                func_ptr = jit_module.load()
+                global_address = jit_module.global_address
+            else:
+                jit_module = None
+                with _compile_lock:
+                    func_ptr = load_object(self.entry['object'], self.name)
+                    if entry_name != self.name:
+                        func_ptr = get_jit_engine().get_function_address(entry_name)
+                    if self.counter_names:
+                        # for copies linked into anonymous functions, which load elsewhere
+                        counters_name = Backend.counters_name(self.name)
+                        binding.add_symbol(counters_name,
+                                           get_jit_engine().get_global_value_address(counters_name))
+                global_address = get_jit_engine().get_global_value_address
+        self.stats.counts['object_size'] = len(self.entry['object'])
+        self.stats.counts['machine_code_size'] = machine_code_size(self.entry['object'])
+        unescaped = self.unescaped
+        params = self.params
+        f = self.f
+        entry = self.entry
+        job = self
 
         def interpret(*interpret_args):
-            return Interpreter().call_fun(func, *interpret_args)
+            return _interpreted(job)(*interpret_args)
 
-        native_runner = functools.partial(run_marshalled, llvm_mod.functions[-1], func_ptr)
+        native_runner = _native_function(self.name, self.ftype, func_ptr)
+        if jit_module is not None:
+            # the function owns its code; it is released when the function is collected
+            native_runner.jit_module = jit_module
+            jit_module.attach(native_runner)
         native_runner.interpret = interpret
         native_runner.py = f
         native_runner.is_scale = True
@@ -149,18 +387,88 @@ def _scale(f, *, lazy=True, generate_llvm=True, dump_unescaped=False, dump_ir=Fa
                     '\n'.join(map(lambda x: '\t' + x, processed_src.split('\n'))))
             return header_src
         native_runner.pretty = gen_pretty
-        native_runner.llvm = lambda: str(list(llvm_mod.functions)[-1])
-        native_runner.opcode = lambda: str(''.join(map(str, opcode.functions)))
+        native_runner.llvm = lambda: str(self.llvm_module().functions[-1])
+        native_runner.opcode = lambda: entry['opcode']
+        native_runner.cache_key = self.key
+        native_runner.options = self.options
+        native_runner.job = self
+        native_runner.compile_stats = self.stats.as_dict
+        if self.counter_names:
+            counter_names = self.counter_names
+            counters_name = Backend.counters_name(self.name)
+            def counters_array():
+                # looked up on every use, as an evicted function comes back at a new address
+                return (ctypes.c_int64 * len(counter_names)).from_address(global_address(counters_name))
+            def read_counters():
+                return dict(zip(counter_names, counters_array()))
+            def reset_counters():
+                counters = counters_array()
+                ctypes.memset(counters, 0, ctypes.sizeof(counters))
+            native_runner.counters = read_counters
+            native_runner.reset_counters = reset_counters
         def compile_inner(*args, **kwargs):
             raise RuntimeError("already compiled")
         native_runner.compile = compile_inner
-        if anonymous:
-            global anon_id
-            native_runner.scale_name = '<anonymous_{}>'.format(anon_id)
-            anon_id += 1
+        if self.anonymous:
+            native_runner.scale_name = '<anonymous_{}>'.format(next(_anon_ids))
         else:
-            native_runner.scale_name = global_name
+            native_runner.scale_name = self.name
         return native_runner
+
+def _parse_function(f):
+    # source lookup dominates the cost of defining a function, and kernels defined in a
+    # loop share one code object, so parse once and hand out copies the caller may mutate
+    code = f.__code__
+    if code not in _parsed_functions:
+        source = inspect.getsource(f)
+        base_indent = len(source) - len(source.lstrip())
+        lines = map(lambda _: _[base_indent:], source.split('\n'))
+        source = '\n'.join(lines).strip()
+        params = list(code.co_varnames[:code.co_argcount])
+        parsed = (params, ast.parse(source).body[0])
+        with _compile_lock:
+            _parsed_functions[code] = parsed
+    params, parse_tree = _parsed_functions[code]
+    return list(params), copy.deepcopy(parse_tree)
+
+def _scale(f, *, lazy=True, generate_llvm=True, dump_unescaped=False, dump_ir=False,
+         dump_llvm=False, dump_opt=False, anonymous=False, depth=1, **options):
+    stats = CompileStats(f.__name__)
+    escape_start = time.perf_counter()
+    # get caller's globals and locals for escape evaluation
+    frame = sys._getframe(depth)
+    _globals = frame.f_globals
+    _locals = frame.f_locals
+    del frame
+    params, parse_tree = _parse_function(f)
+    unescaped = ProcessEscape(params, _globals, _locals).visit(parse_tree)
+
+    if dump_unescaped:
+        import astunparse
+        processed_src = astunparse.unparse(unescaped.body).strip()
+        header_src = 'def ___{}_inner({}):\n{}'.format(
+                f.__name__,
+                ', '.join(params),
+                '\n'.join(map(lambda x: '\t' + x, processed_src.split('\n'))))
+        print(header_src)
+
+    stats.phases['escape'] = time.perf_counter() - escape_start
+    stats.counts['ast_nodes'] = count_nodes(unescaped)
+
+    extract = _FuncCallExtractor()
+    extract.visit(unescaped)
+    job = _CompileJob(f, unescaped, params, extract.calls, _globals, _locals,
+                      codegen_options(**options), stats, anonymous, dump_ir, dump_llvm, dump_opt)
+
+    if lazy:
+        yield job
+
+    job.compile_deps()
+
+    if generate_llvm:
+        job.generate()
+        job.optimize()
+        return job.finish()
     else:
         # convert ast -> python and exec it
         import astunparse
@@ -172,83 +480,395 @@ def _scale(f, *, lazy=True, generate_llvm=True, dump_unescaped=False, dump_ir=Fa
         exec(header_src, _globals, _locals)
         return _locals['___{}_inner'.format(f.__name__)]
 
-def scale(*args, **kwargs):
+def _ensure_compiled(inner):
+    # lazy compilation happens exactly once even when several threads make the first call
+    if not inner.is_compiled:
+        with getattr(inner, 'compile_lock', _compile_lock):
+            if not inner.is_compiled:
+                inner.compile()
+
+def _run_compile_hooks(*jobs):
+    # run only once the code is installed, so a failing callback cannot leave a function
+    # unusable; the first error is raised after every callback has had its turn
+    error = None
+    for job in jobs:
+        for hook in list(_compile_hooks):
+            try:
+                hook(job.stats.as_dict())
+            except Exception as e:
+                if error is None:
+                    error = e
+    if error is not None:
+        raise error
+
+def _install(inner, compiled):
+    for x in dir(compiled):
+        if x[:2] != '__' and x not in ('func', 'is_compiled'):
+            setattr(inner, x, getattr(compiled, x))
+    # swap in the native code before publishing it to concurrent callers
+    inner.func = compiled
+    inner.is_compiled = True
+
+def _dependency_order(fns):
+    order = []
+    visiting = set()
+    done = set()
+    def visit(fn):
+        if fn in done or fn in visiting:
+            return
+        visiting.add(fn)
+        for dp in fn.job.dependencies():
+            if not dp.is_compiled and hasattr(dp, 'job'):
+                visit(dp)
+        visiting.discard(fn)
+        done.add(fn)
+        order.append(fn)
+    for fn in fns:
+        if not fn.is_compiled:
+            visit(fn)
+    return order
+
+def compile_all(*fns, parallel=None):
+    with _compile_all_lock, contextlib.ExitStack() as stack:
+        order = _dependency_order(fns)
+        # callers before callees, the order a lazy compile takes them in
+        for fn in reversed(order):
+            stack.enter_context(fn.compile_lock)
+        order = [fn for fn in order if not fn.is_compiled]
+        deferred = set(order)
+        for fn in order:
+            fn.job.compile_deps(deferred)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel or os.cpu_count()) as pool:
+            futures = []
+            for fn in order:
+                fn.job.generate()
+                futures.append(pool.submit(fn.job.optimize))
+            for fn, future in zip(order, futures):
+                future.result()
+                fn.func.close()
+                _install(fn, fn.job.finish())
+    _run_compile_hooks(*[fn.job for fn in order])
+
+@functools.lru_cache()
+def _tier_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='scale-compile')
+
+def _interpreted(job):
+    with _interpret_lock:
+        if job.interpreted is None:
+            signatures = dict(global_vars)
+            signatures.setdefault(job.name, _signature(job.unescaped))
+            for name in job.deps - {job.name}:
+                # callees not compiled yet are typechecked against their declared signatures
+                dep_job = getattr(eval(name, job.globals, job.locals), 'job', None)
+                if dep_job is not None:
+                    signatures.setdefault(name, _signature(dep_job.unescaped))
+            func = Frontend().visit(job.unescaped)
+            TypeChecker.analyze(func, signatures)
+            # published before it is compiled, so callees that call back find it
+            job.interpreted = InterpretedFunction(func)
+            try:
+                job.interpreted.compile(functools.partial(_interpreted_callee, job))
+            except BaseException:
+                job.interpreted = None
+                raise
+        return job.interpreted
+
+def _interpreted_callee(job, name):
+    callee = eval(name, job.globals, job.locals)
+    if getattr(callee, 'job', None) is not None:
+        return _interpreted(callee.job)
+    signature = global_vars.get(name)
+    if not TypeChecker.native(signature):
+        raise NotImplementedError('cannot interpret the call to {}'.format(name))
+    if isinstance(signature.return_type, llvm.PointerType):
+        raise NotImplementedError('cannot interpret the call to {}, which returns an array'.format(name))
+    try:
+        symbol = getattr(ctypes.CDLL(None), name)
+    except AttributeError:
+        raise NotImplementedError('native function {} is not loaded in this process'.format(name))
+    return _native_function(name, signature, ctypes.cast(symbol, ctypes.c_void_p).value)
+
+def _interpreted_tier(inner, job, tier_threshold):
+    def tier_up():
+        _ensure_compiled(inner)
+
+    def start_tier_up():
+        with _compile_lock:
+            if inner.tier_future is None:
+                inner.tier_future = _tier_executor().submit(tier_up)
+            return inner.tier_future
+
+    def call(*args):
+        inner.calls += 1
+        if inner.tier_future is None and inner.calls >= tier_threshold:
+            start_tier_up()
+        if inner.tier_future is not None and inner.tier_future.done():
+            # surfaces compilation errors to the caller
+            inner.tier_future.result()
+        if inner.is_compiled:
+            return inner.func(*args)
+        if inner.interpreted is None:
+            try:
+                inner.interpreted = _interpreted(job)
+            except NotImplementedError:
+                inner.interpreted = False
+        if inner.interpreted is False:
+            start_tier_up().result()
+            return inner.func(*args)
+        return inner.interpreted(*args)
+
+    def wait_compiled(timeout=None):
+        if inner.is_compiled:
+            return True
+        try:
+            start_tier_up().result(timeout)
+        except concurrent.futures.TimeoutError:
+            return False
+        return True
+
+    inner.calls = 0
+    inner.tier_future = None
+    inner.interpreted = None
+    inner.wait_compiled = wait_compiled
+    if tier_threshold <= 0:
+        start_tier_up()
+    return call
+
+def _specialize_constant(job, param, value):
+    annotation = job.unescaped.args.args[job.params.index(param)].annotation
+    kind = getattr(annotation, 'id', None)
+    if kind == 'int' and isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if kind == 'float' and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if kind == 'bool' and isinstance(value, bool):
+        return value
+    # not something that can become a constant; the generic version handles it
+    return None
+
+def _constant_key(value):
+    # -0.0 == 0.0 and nan != nan, so floats are told apart by their bits
+    return struct.pack('<d', value) if isinstance(value, float) else value
+
+def _specialized_versions(inner, job, specialize, max_versions):
+    for param in specialize:
+        if param not in job.params:
+            raise ValueError('cannot specialize on {}: not a parameter of {}'.format(param, job.name))
+    indices = [job.params.index(param) for param in specialize]
+
+    def compile_version(constants):
+        unescaped = copy.deepcopy(job.unescaped)
+        # rebinding the parameters up front lets LLVM fold them as constants
+        unescaped.body[:0] = [ast.Assign(targets=[ast.Name(id=param, ctx=ast.Store())],
+                                         value=to_ast(value))
+                              for param, value in zip(specialize, constants)]
+        # a symbol of its own, so recursive calls go to the generic entry point rather than
+        # back into this version, which would bind the constants again on every entry
+        name = '{}.specialized'.format(job.name)
+        unescaped.name = name
+        version = _CompileJob(job.f, unescaped, job.params, job.deps, job.globals, job.locals,
+                              job.options, CompileStats(job.name), anonymous=True, name=name)
+        version.compile_deps()
+        version.generate()
+        version.optimize()
+        return version.finish()
+
+    def call(*args):
+        if len(args) != len(job.params):
+            raise TypeError('expected {} arguments, got {}'.format(len(job.params), len(args)))
+        constants = tuple(_specialize_constant(job, job.params[i], args[i]) for i in indices)
+        if None in constants:
+            inner.generic_calls += 1
+            _ensure_compiled(inner)
+            return inner.func(*args)
+        key = tuple(map(_constant_key, constants))
+        version = inner.versions.get(key)
+        if version is None:
+            with inner.compile_lock:
+                version = inner.versions.get(key)
+                if version is None:
+                    version = inner.versions[key] = compile_version(constants)
+                    if len(inner.versions) > max_versions:
+                        inner.versions.popitem(last=False)
+                    _run_compile_hooks(version.job)
+        else:
+            try:
+                inner.versions.move_to_end(key)
+            except KeyError:
+                # evicted by another thread since the lookup; this call still holds it
+                pass
+        return version(*args)
+
+    inner.versions = collections.OrderedDict()
+    inner.generic_calls = 0
+    return call
+
+_type_names = dict(TypeChecker.scalar_types, **TypeChecker.vector_types)
+
+def _bind_type_vars(annotation, typ, bindings):
+    if isinstance(annotation, ast.List):
+        if not isinstance(typ, llvm.PointerType):
+            raise TypeError('expected an array, got {}'.format(typ))
+        return _bind_type_vars(annotation.elts[0], typ.pointee, bindings)
+    if isinstance(annotation, ast.Name) and annotation.id not in _type_names:
+        if bindings.setdefault(annotation.id, typ) != typ:
+            raise TypeError('type variable {} bound to both {} and {}'.format(
+                annotation.id, bindings[annotation.id], typ))
+        return
+    expected = _type_names[annotation.id] if isinstance(annotation, ast.Name) else None
+    if expected != typ:
+        raise TypeError('expected {}, got {}'.format(expected, typ))
+
+def _type_annotation(typ):
+    if isinstance(typ, llvm.PointerType):
+        return ast.List(elts=[_type_annotation(typ.pointee)], ctx=ast.Load())
+    for name, scalar in _type_names.items():
+        if scalar == typ:
+            return ast.Name(id=name, ctx=ast.Load())
+    raise NotImplementedError('no annotation for {}'.format(typ))
+
+class _SubstituteTypeVars(ast.NodeTransformer):
+    def __init__(self, bindings):
+        self.bindings = bindings
+
+    def visit_Name(self, node):
+        if node.id in self.bindings:
+            return _type_annotation(self.bindings[node.id])
+        return node
+
+def _generic_instances(inner, job):
+    annotations = [arg.annotation for arg in job.unescaped.args.args] + [job.unescaped.returns]
+    type_vars = [set() for _ in annotations]
+    for annotation, names in zip(annotations, type_vars):
+        for node in ast.walk(annotation):
+            if isinstance(node, ast.Name) and node.id not in _type_names:
+                if not isinstance(eval(node.id, job.globals, job.locals), typing.TypeVar):
+                    raise TypeError('{} in the signature of {} is neither a type nor a TypeVar'.format(
+                        node.id, job.name))
+                names.add(node.id)
+    # type variables are bound from the arguments only
+    unbound = type_vars[-1].difference(*type_vars[:-1])
+    if unbound:
+        raise TypeError('type variable {} of {} appears only in its return type'.format(
+            ', '.join(sorted(unbound)), job.name))
+
+    def instantiate(bindings):
+        unescaped = copy.deepcopy(job.unescaped)
+        substitute = _SubstituteTypeVars(bindings)
+        for arg in unescaped.args.args:
+            arg.annotation = substitute.visit(arg.annotation)
+        unescaped.returns = substitute.visit(unescaped.returns)
+        instance = _CompileJob(job.f, unescaped, job.params, job.deps, job.globals, job.locals,
+                               job.options, CompileStats(job.name), anonymous=True)
+        instance.compile_deps()
+        instance.generate()
+        instance.optimize()
+        return instance.finish()
+
+    def call(*args):
+        if len(args) != len(job.params):
+            raise TypeError('expected {} arguments, got {}'.format(len(job.params), len(args)))
+        bindings = {}
+        for arg, value in zip(job.unescaped.args.args, args):
+            _bind_type_vars(arg.annotation, MarshalledArg.infer_type(value), bindings)
+        key = tuple(sorted((name, str(typ)) for name, typ in bindings.items()))
+        instance = inner.instances.get(key)
+        if instance is None:
+            with inner.compile_lock:
+                instance = inner.instances.get(key)
+                if instance is None:
+                    instance = inner.instances[key] = instantiate(bindings)
+                    _run_compile_hooks(instance.job)
+        return instance(*args)
+
+    def compile_inner(*args, **kwargs):
+        raise RuntimeError('generic functions are compiled for each signature they are called with')
+
+    inner.instances = {}
+    inner.compile = compile_inner
+    return call
+
+def scale(*args, tiered=False, tier_threshold=1, specialize=None, max_versions=8, generic=False,
+          **kwargs):
     if len(args) == 1:
-        kwargs['depth'] = 2
+        if not kwargs.get('lazy', True) and (tiered or specialize or generic):
+            raise ValueError('tiered, specialize and generic functions must be compiled lazily')
+        kwargs.setdefault('depth', 2)
         gen = _scale(args[0], **kwargs)
         try:
-            next(gen)
+            job = next(gen)
         except StopIteration as e:
+            if getattr(e.value, 'job', None) is not None:
+                _run_compile_hooks(e.value.job)
             return e.value
         else:
             def inner(*args, **kwargs):
+                if generic:
+                    return instantiated(*args)
+                if specialize:
+                    return specialized(*args)
                 if not inner.is_compiled:
-                    inner.compile()
+                    if tiered:
+                        return interpreted(*args, **kwargs)
+                    _ensure_compiled(inner)
                 return inner.func(*args, **kwargs)
             inner.is_scale = True
             inner.is_defined = True
             inner.is_compiled = False
             inner.func = gen
             inner.scale_name = args[0].__name__
-            def compile_inner(inner):
-                if inner.is_compiled:
-                    raise RuntimeError("already compiiled")
-                try:
-                    next(inner.func)
-                except StopIteration as e:
-                    for x in dir(e.value):
-                        if x[:2] != '__':
-                            setattr(inner, x, getattr(e.value, x))
-                    inner.func = e.value
+            inner.job = job
+            inner.compile_stats = job.stats.as_dict
+            inner.compile_lock = threading.RLock()
+            def interpret(*args):
+                return _interpreted(job)(*args)
+            inner.interpret = interpret
+            def bind(*args):
+                _ensure_compiled(inner)
+                return inner.func.bind(*args)
+            inner.bind = bind
+            def compile_inner(inner, parallel=None):
+                if parallel is not None:
+                    if inner.is_compiled:
+                        raise RuntimeError("already compiiled")
+                    compile_all(inner, parallel=parallel)
+                    return
+                with inner.compile_lock:
+                    if inner.is_compiled:
+                        raise RuntimeError("already compiiled")
+                    try:
+                        next(inner.func)
+                    except StopIteration as e:
+                        _install(inner, e.value)
+                _run_compile_hooks(inner.job)
             inner.compile = functools.partial(compile_inner, inner)
+            if tiered:
+                interpreted = _interpreted_tier(inner, job, tier_threshold)
+            if specialize:
+                specialized = _specialized_versions(inner, job, specialize, max_versions)
+            if generic:
+                instantiated = _generic_instances(inner, job)
             return inner
     else:
-        return functools.partial(scale, **kwargs)
-
-class _FuncDefTypeExtractor(SubexprVisitor):
-    def visit_List(self, node):
-        return [self.visit(x) for x in node.elts]
-
-    def visit_Name(self, node):
-        if node.id == 'int':
-            return TypeChecker.int_type
-        if node.id == 'float':
-            return TypeChecker.float_type
-        if node.id == 'bool':
-            return TypChecker.bool_typpe
-        return node
-
-    def collapse_to_pointer(self, typ):
-        if isinstance(typ, list):
-            return llvm.PointerType(self.collapse_to_pointer(typ[0]))
-        else:
-            return typ
-
-    def visit_FunctionDef(self, node):
-        args = []
-        for x in node.args.args:
-            args.append(self.collapse_to_pointer(self.visit(x.annotation)))
-        ret = self.collapse_to_pointer(self.visit(node.returns))
+        return functools.partial(scale, tiered=tiered, tier_threshold=tier_threshold,
+                                 specialize=specialize, max_versions=max_versions,
+                                 generic=generic, **kwargs)
 
-        if len(node.body) != 1 or not isinstance(node.body[0], ast.Pass):
-            raise TypeError('expected empty function body')
-
-        self.type = llvm.FunctionType(ret, tuple(args))
-        return node
+def _declared_signature(parse_tree):
+    if len(parse_tree.body) != 1 or not isinstance(parse_tree.body[0], ast.Pass):
+        raise TypeError('expected empty function body')
+    return _signature(parse_tree)
 
 def ___declare(f):
-    source = inspect.getsource(f)
-    base_indent = len(source) - len(source.lstrip())
-    lines = map(lambda _: _[base_indent:], source.split('\n'))
-    source = '\n'.join(lines).strip()
-    parse_tree = ast.parse(source).body[0]
+    _, parse_tree = _parse_function(f)
 
     global_name = f.__name__
 
-    extract = _FuncDefTypeExtractor()
-    extract.visit(parse_tree)
+    signature = _declared_signature(parse_tree)
 
-    global_vars[global_name] = extract.type
+    with _compile_lock:
+        global_vars[global_name] = signature
 
     def inner(*args, **kwargs):
         raise RuntimeError('function only declared, not defined')
@@ -270,18 +890,16 @@ def __declare(*args, **kwargs):
         return functools.partial(__declare, **kwargs)
 
 def ___native(f):
-    source = inspect.getsource(f)
-    base_indent = len(source) - len(source.lstrip())
-    lines = map(lambda _: _[base_indent:], source.split('\n'))
-    source = '\n'.join(lines).strip()
-    parse_tree = ast.parse(source).body[0]
+    _, parse_tree = _parse_function(f)
 
     global_name = f.__name__
 
-    extract = _FuncDefTypeExtractor()
-    extract.visit(parse_tree)
+    signature = _declared_signature(parse_tree)
+    # arrays a native function returns are not Scale's to free
+    signature.native = True
 
-    global_vars[global_name] = extract.type
+    with _compile_lock:
+        global_vars[global_name] = signature
 
     def inner(*args, **kwargs):
         raise NotImplementedError('calling native function from python not supported')
@@ -302,19 +920,142 @@ def __native(*args, **kwargs):
     else:
         return functools.partial(__native, **kwargs)
 
-varid = 0
+_var_ids = itertools.count()
 def __newvar():
-    global varid
-    name = '__scale_generated_var_{}'.format(varid)
-    varid += 1
+    name = '__scale_generated_var_{}'.format(next(_var_ids))
     return ast.Name(id=name)
 
 def __var(name):
     return ast.Name(id=name)
 
+def __on_compile(callback):
+    _compile_hooks.append(callback)
+    return callback
+
+__on_compile.remove = _compile_hooks.remove
+
+def __enable_cache(path=None, max_size=256 * 1024 * 1024):
+    global object_cache
+    object_cache = ObjectCache(path, max_size)
+    return object_cache
+
+def __disable_cache():
+    global object_cache
+    object_cache = None
+
+def __limit_code_memory(max_size=None):
+    code_space.set_max_size(max_size)
+    return code_space
+
+_dtypes = {'int8': numpy.int8, 'uint8': numpy.uint8, 'int16': numpy.int16, 'int': numpy.int32,
+           'int64': numpy.int64, 'float32': numpy.float32, 'float': numpy.double}
+
+def _vector_operand(arg, dtype):
+    # cast as a ufunc would under same_kind casting, except that integers are checked by
+    # value, so Python ints fit narrow types and values out of range raise instead of wrapping
+    array = numpy.asarray(arg)
+    dtype = numpy.dtype(dtype)
+    if array.dtype.kind in 'iu' and dtype.kind in 'iu':
+        info = numpy.iinfo(dtype)
+        if array.size and (array.min() < info.min or array.max() > info.max):
+            raise TypeError('values out of range for {}'.format(dtype))
+    elif not numpy.can_cast(array.dtype, dtype, 'same_kind'):
+        raise TypeError('cannot cast {} to {}'.format(array.dtype, dtype))
+    return array.astype(dtype, copy=False)
+
+def _vectorized_kernel(fn, contiguous, options):
+    # the loop calls the scalar function by name; linking inlines it so the loop vectorizes
+    job = fn.job
+    name = '{}.{}'.format(job.name, 'contiguous' if contiguous else 'strided')
+    kinds = [arg.annotation.id for arg in job.unescaped.args.args] + [job.unescaped.returns.id]
+    index = '[i]' if contiguous else '[i * s{}]'
+    params = []
+    for k, kind in enumerate(kinds):
+        params.append('a{}: [{}]'.format(k, kind))
+        if not contiguous:
+            params.append('s{}: int'.format(k))
+    call = '{}({})'.format(job.name, ', '.join(
+        'a{}'.format(k) + index.format(k) for k in range(len(kinds) - 1)))
+    source = 'def kernel({}, n: int) -> int:\n' \
+             '    for i in range(n):\n' \
+             '        a{}{} = {}\n' \
+             '    return 0\n'.format(', '.join(params), len(kinds) - 1,
+                                     index.format(len(kinds) - 1), call)
+    unescaped = ast.parse(source).body[0]
+    unescaped.name = name
+    options = dict(dict(link=True, vectorize=True), **options)
+    kernel = _CompileJob(job.f, unescaped, [arg.arg for arg in unescaped.args.args], {job.name},
+                         {job.name: fn}, {}, codegen_options(**options), CompileStats(name),
+                         anonymous=True, name=name)
+    kernel.compile_deps()
+    kernel.generate()
+    kernel.optimize()
+    return kernel.finish()
+
+def __vectorize(*args, **options):
+    if len(args) != 1:
+        return functools.partial(__vectorize, **options)
+    fn = args[0]
+    if not getattr(fn, 'is_scale', False):
+        fn = scale(fn, depth=3, **options)
+    if fn.job.anonymous:
+        raise ValueError('cannot vectorize an anonymous function')
+    kinds = [arg.annotation for arg in fn.job.unescaped.args.args] + [fn.job.unescaped.returns]
+    for kind in kinds:
+        if getattr(kind, 'id', None) not in _dtypes:
+            raise NotImplementedError('vectorized functions take and return numeric scalars')
+    kinds = [kind.id for kind in kinds]
+    kernels = {}
+    kernels_lock = threading.Lock()
+
+    def kernel(contiguous):
+        if contiguous not in kernels:
+            with kernels_lock:
+                if contiguous not in kernels:
+                    kernels[contiguous] = _vectorized_kernel(fn, contiguous, options)
+                    _run_compile_hooks(kernels[contiguous].job)
+        return kernels[contiguous]
+
+    def vectorized(*args, out=None):
+        if len(args) != len(kinds) - 1:
+            raise TypeError('expected {} arguments, got {}'.format(len(kinds) - 1, len(args)))
+        arrays = [_vector_operand(arg, _dtypes[kind]) for arg, kind in zip(args, kinds)]
+        shape = numpy.broadcast(*arrays).shape
+        scalar = out is None and not shape
+        if out is None:
+            out = numpy.empty(shape, dtype=_dtypes[kinds[-1]])
+        elif out.shape != shape or out.dtype != _dtypes[kinds[-1]]:
+            raise ValueError('out must be a {} array of shape {}'.format(
+                numpy.dtype(_dtypes[kinds[-1]]), shape))
+        arrays.append(out)
+        if all(a.shape == shape and a.flags.c_contiguous for a in arrays):
+            kernel(True)(*[a.reshape(-1) for a in arrays], out.size)
+        else:
+            # broadcast operands have zero strides; walk all but the innermost axis here
+            strided = kernel(False)
+            views = [numpy.broadcast_to(a, shape) for a in arrays[:-1]] + [out]
+            for index in numpy.ndindex(*shape[:-1]):
+                row_args = []
+                for view in views:
+                    row = view[index]
+                    row_args += [row, row.strides[0] // row.itemsize]
+                strided(*row_args, shape[-1])
+        return out[()] if scalar else out
+
+    vectorized.scalar = fn
+    vectorized.kernels = kernels
+    return vectorized
+
 scale.declare = __declare
 scale.native = __native
 scale.anonymous = functools.partial(scale, anonymous=True)
+scale.generic = functools.partial(scale, generic=True)
+scale.vectorize = __vectorize
 scale.newvar = __newvar
 scale.var = __var
+scale.compile_all = compile_all
+scale.on_compile = __on_compile
+scale.enable_cache = __enable_cache
+scale.disable_cache = __disable_cache
+scale.limit_code_memory = __limit_code_memory
 
@@ -1,22 +1,21 @@
 from macropy.core.quotes import macros, q, name
 
 import ast
-import astunparse
+import collections
+import copy
+import threading
+
+from .typechecker import TypeChecker
 
 def flatten(x):
     try:
         itr = iter(x)
     except TypeError:
         yield x
-        raise StopIteration
     else:
-        cur_itr = flatten(next(itr))
-        while True:
-            try:
-                yield next(cur_itr)
-            except StopIteration:
-                cur_itr = flatten(next(itr))
-            
+        for item in itr:
+            yield from flatten(item)
+
 class SubexprVisitor(ast.NodeVisitor):
     """
     AST node visitor that just visits every node in a Python AST.
@@ -39,6 +38,9 @@ class SubexprVisitor(ast.NodeVisitor):
     def visit_Str(self, node):
         return node
 
+    def visit_str(self, node):
+        return node
+
     def visit_list(self, nodes):
         r = list(map(self.visit, nodes))
         return r
@@ -66,20 +68,70 @@ def to_ast(maybe_ast):
     else:
         return q[u[maybe_ast]]
 
+class _EscapeScope(dict):
+    """
+    Names bound while processing escapes, falling back to the caller's locals. Names that
+    are neither bound nor global stand for themselves in the generated code.
+    """
+    def __init__(self, _globals, _locals):
+        self.globals = _globals
+        self.locals = _locals
+
+    def __missing__(self, key):
+        if key in self.locals:
+            return self.locals[key]
+        if key in self.globals:
+            # let eval find it among the globals
+            raise KeyError(key)
+        return q[name[key]]
+
+    def lookup(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            return self.globals[key]
+
+
+# least recently used first; functions are defined from several threads
+_compiled_escapes = collections.OrderedDict()
+_compiled_escapes_lock = threading.Lock()
+MAX_COMPILED_ESCAPES = 1024
+
+def compile_escape(node):
+    # escapes are keyed by structure, as kernels defined in a loop get fresh copies of the same tree
+    key = ast.dump(node)
+    with _compiled_escapes_lock:
+        code = _compiled_escapes.get(key)
+        if code is not None:
+            _compiled_escapes.move_to_end(key)
+            return code
+    expression = ast.fix_missing_locations(ast.Expression(body=copy.deepcopy(node)))
+    code = compile(expression, '<escape>', 'eval')
+    with _compiled_escapes_lock:
+        _compiled_escapes[key] = code
+        if len(_compiled_escapes) > MAX_COMPILED_ESCAPES:
+            _compiled_escapes.popitem(last=False)
+    return code
+
 class ProcessEscape(SubexprVisitor):
     """
     AST node visitor that transforms the AST to remove escapes.
     """
     def __init__(self, params, _globals, _locals):
-        self.globals = _globals.copy()
-        self.locals = _locals.copy()
+        # only read from, so the caller's module dict is used as is
+        self.globals = _globals
+        self.locals = _EscapeScope(_globals, _locals)
         self.names = set(list(params))
-        if 'goto' in self.globals or 'goto' in self.locals:
+        if 'goto' in self.globals or 'goto' in _locals:
             self.names.add('goto')
             self.locals['goto'] = q[goto]
-        if 'label' in self.globals or 'label' in self.locals:
+        if 'label' in self.globals or 'label' in _locals:
             self.names.add('label')
             self.locals['label'] = q[label]
+        # names scale exports for use inside kernels stand for themselves
+        for builtin in ['prange'] + list(TypeChecker.scalar_types) + list(TypeChecker.vector_types):
+            if builtin in self.globals or builtin in _locals:
+                self.names.add(builtin)
         for p in params:
             self.locals[p] = q[name[p]]
 
@@ -92,13 +144,10 @@ class ProcessEscape(SubexprVisitor):
         return rv
 
     def process_escape(self, node):
-        ne = NameExtractor()
-        ne.visit(node)
-        _locals = self.locals.copy()
-        for n in ne.names:
-            if n not in self.globals and n not in _locals:
-                _locals[n] = q[name[n]]
-        ev = eval(astunparse.unparse(node), self.globals, _locals)
+        if isinstance(node, ast.Name):
+            ev = self.locals.lookup(node.id)
+        else:
+            ev = eval(compile_escape(node), self.globals, self.locals)
         if hasattr(ev, 'is_scale') and ev.is_scale:
             return node
         x = self.visit(to_ast(ev))
@@ -0,0 +1,269 @@
+import collections
+import concurrent.futures
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy
+import llvmlite.binding as binding
+
+from .backend import Backend
+from .compile import _compile_lock, _ensure_compiled, _entry_name, _native_function, create_jit_engine
+from .jit import CodeSpace, JITModule
+from .typechecker import TypeChecker
+
+# an ndarray argument travelling to a worker as the shared memory segment that holds it
+_SharedArray = collections.namedtuple('_SharedArray',
+                                      'segment offset shape strides dtype temporary')
+
+# worker side: the shipped functions, and segments attached once and reused across tasks
+_worker_functions = {}
+_worker_segments = {}
+_worker_engines = []
+
+def _initialize_worker(named, functions):
+    # named functions go into one engine and are finalized together, so calls between
+    # them resolve whatever order they were shipped in
+    engine = create_jit_engine()
+    for name, obj in named:
+        engine.add_object_file(binding.ObjectFileRef.from_data(obj))
+    engine.finalize_object()
+    for name, _ in named:
+        binding.add_symbol(name, engine.get_function_address(name))
+        # instrumented functions linked into anonymous ones count through this symbol
+        counters = engine.get_global_value_address(Backend.counters_name(name))
+        if counters:
+            binding.add_symbol(Backend.counters_name(name), counters)
+    _worker_engines.append(engine)
+    # a forked worker inherits the parent's locks in whatever state they were in
+    space = CodeSpace()
+    for key, (name, obj, ftype, anonymous) in functions.items():
+        module = None
+        if anonymous:
+            module = JITModule(obj, _entry_name(name, ftype), create_jit_engine, space)
+            address = module.load()
+        else:
+            address = engine.get_function_address(_entry_name(name, ftype))
+        native = _native_function(name, ftype, address)
+        if module is not None:
+            native.jit_module = module
+            module.attach(native)
+        _worker_functions[key] = native
+
+# parent side: work to run inside llvmlite's lock, through the callback it offers on acquiring it
+_llvm_lock_state = threading.local()
+
+def _llvm_lock_acquired():
+    action = getattr(_llvm_lock_state, 'action', None)
+    if action is not None:
+        _llvm_lock_state.action = None
+        _llvm_lock_state.result = action()
+
+binding.ffi.register_lock_callback(_llvm_lock_acquired, lambda: None)
+
+def _holding_llvm_lock(action):
+    # any call into llvmlite takes its lock, and the callback runs action while it is held
+    _llvm_lock_state.action = action
+    try:
+        binding.get_process_triple()
+        return _llvm_lock_state.result
+    finally:
+        _llvm_lock_state.action = None
+        _llvm_lock_state.result = None
+
+def _attach(arg, temporaries):
+    if not isinstance(arg, _SharedArray):
+        return arg
+    if arg.temporary:
+        segment = shared_memory.SharedMemory(name=arg.segment)
+        temporaries.append(segment)
+    else:
+        segment = _worker_segments.get(arg.segment)
+        if segment is None:
+            segment = _worker_segments[arg.segment] = shared_memory.SharedMemory(name=arg.segment)
+    return numpy.ndarray(arg.shape, numpy.dtype(arg.dtype), buffer=segment.buf,
+                         offset=arg.offset, strides=arg.strides)
+
+def _run(key, args):
+    temporaries = []
+    args = [_attach(arg, temporaries) for arg in args]
+    try:
+        return _worker_functions[key](*args)
+    finally:
+        # the views must go before their segments can be closed
+        del args
+        for segment in temporaries:
+            segment.close()
+
+
+class ProcessExecutor(object):
+    """
+    Runs compiled Scale functions in a pool of worker processes. The object code of each
+    function and of the named functions it calls is shipped to every worker once, when the
+    worker starts. Arrays made with array() or share() live in shared memory and are passed
+    to workers without copying; other ndarray arguments are copied into shared memory for
+    the call and copied back once it returns.
+    """
+    def __init__(self, *fns, max_workers=None, mp_context=None):
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self.keys = {}
+        self.named = collections.OrderedDict()
+        self.functions = {}
+        self.segments = {}
+        self.pool = None
+        for fn in fns:
+            self.register(fn)
+
+    def register(self, fn):
+        if fn in self.keys:
+            return fn
+        if self.pool is not None:
+            raise RuntimeError('functions must be registered before the first call is submitted')
+        _ensure_compiled(fn)
+        job = getattr(fn, 'job', None)
+        if job is None or job.entry is None:
+            raise TypeError('only compiled Scale functions can run in worker processes')
+        with _compile_lock:
+            self.ship_dependencies(job, set([job.name]))
+        if not job.anonymous:
+            self.named[job.name] = job.entry['object']
+        key = len(self.keys)
+        self.functions[key] = (job.name, job.entry['object'], job.ftype, job.anonymous)
+        self.keys[fn] = key
+        return fn
+
+    def ship_dependencies(self, job, seen):
+        # callees first; native functions are found among the worker's own symbols
+        for dep in job.dependencies():
+            dep_job = getattr(dep, 'job', None)
+            if dep_job is None or dep_job.name in seen:
+                continue
+            if dep_job.anonymous:
+                raise NotImplementedError('calls to anonymous functions in worker processes')
+            seen.add(dep_job.name)
+            self.ship_dependencies(dep_job, seen)
+            self.named[dep_job.name] = dep_job.entry['object']
+
+    def start(self):
+        if self.pool is None:
+            # workers have to share this process's tracker; one of their own would unlink
+            # the segments they attached to when they exit
+            resource_tracker.ensure_running()
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers, self.mp_context, _initialize_worker,
+                (list(self.named.items()), self.functions))
+        return self.pool
+
+    def allocate(self, shape, dtype):
+        dtype = numpy.dtype(dtype)
+        size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+        segment = shared_memory.SharedMemory(create=True, size=size)
+        return segment, numpy.ndarray(shape, dtype, buffer=segment.buf)
+
+    def array(self, shape, dtype=numpy.double):
+        segment, array = self.allocate(shape, dtype)
+        array[...] = 0
+        self.segments[id(segment.buf)] = segment
+        return array
+
+    def share(self, arg):
+        arg = numpy.asarray(arg)
+        array = self.array(arg.shape, arg.dtype)
+        array[...] = arg
+        return array
+
+    def segment(self, arg):
+        # views of views all report the array made over the segment's buffer as their base
+        base = arg
+        while isinstance(base, numpy.ndarray):
+            base = base.base
+        return self.segments.get(id(base))
+
+    def describe(self, arg, copies, intent):
+        if not isinstance(arg, numpy.ndarray):
+            return arg
+        segment = self.segment(arg)
+        temporary = segment is None
+        if temporary:
+            # new segments start zeroed, which is all an Out array needs
+            segment, shared = self.allocate(arg.shape, arg.dtype)
+            if intent != 'Out':
+                shared[...] = arg
+            copies.append((arg if intent != 'In' else None, shared, segment))
+            arg = shared
+        start = numpy.frombuffer(segment.buf, numpy.uint8).ctypes.data
+        return _SharedArray(segment.name, arg.ctypes.data - start, arg.shape, arg.strides,
+                            arg.dtype.str, temporary)
+
+    def submit(self, fn, *args):
+        key = self.keys.get(fn)
+        if key is None:
+            key = self.keys[self.register(fn)]
+        ftype = self.functions[key][2]
+        if len(args) != len(ftype.args):
+            raise TypeError('expected {} arguments, got {}'.format(len(ftype.args), len(args)))
+        pool = self.start()
+        copies = []
+        try:
+            described = [self.describe(arg, copies, TypeChecker.intent(typ))
+                         for arg, typ in zip(args, ftype.args)]
+            # forked workers start on the first submit; a thread inside LLVM meanwhile, if
+            # only to release an object, would leave the child its lock held for good
+            task = _holding_llvm_lock(lambda: pool.submit(_run, key, described))
+        except BaseException:
+            self.release(copies)
+            raise
+        if not copies:
+            return task
+        # results are handed out only once the temporary copies are back in the caller's arrays
+        future = concurrent.futures.Future()
+        def done(task):
+            try:
+                result = task.result()
+                self.copy_back(copies)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self.release(copies)
+        task.add_done_callback(done)
+        return future
+
+    def copy_back(self, copies):
+        for arg, shared, _ in copies:
+            if arg is not None:
+                arg[...] = shared
+
+    def release(self, copies):
+        # popping drops the last view of each segment, which has to go before it can be closed
+        while copies:
+            segment = copies.pop()[2]
+            segment.close()
+            segment.unlink()
+
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        def results():
+            for future in futures:
+                yield future.result()
+        return results()
+
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait)
+            self.pool = None
+        for segment in self.segments.values():
+            try:
+                segment.close()
+            except BufferError:
+                # arrays over it are still referenced; the mapping goes away with them
+                pass
+            segment.unlink()
+        self.segments.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -33,6 +33,10 @@ class Frontend(ast.NodeVisitor):
                     raise NotImplementedError('Casts expect single argument')
                 arg = self.visit(node.args[0])
                 return ir.CastToFloat(arg)
+            if node.func.id in ('float32', 'int8', 'uint8', 'int16', 'int64'):
+                if len(node.args) != 1:
+                    raise NotImplementedError('Casts expect single argument')
+                return ir.Cast(node.func.id, self.visit(node.args[0]))
             else:
                 args = []
                 for i in node.args:
@@ -58,9 +62,6 @@ class Frontend(ast.NodeVisitor):
                 'BinOp \'{}\' not among Add, Sub, Mult, Div, Mod'.format(Frontend.type_name(node.op)))
         lhs = self.visit(node.left)
         rhs = self.visit(node.right)
-        if op == ir.Bop.Div:
-            lhs = ir.CastToFloat(lhs)
-            rhs = ir.CastToFloat(rhs)
         return ir.BinOp(op=op, left=lhs, right=rhs)
 
     def visit_BoolOp(self, node):
@@ -120,6 +121,11 @@ class Frontend(ast.NodeVisitor):
         #  | ExtSlice(slice* dims)
         #  | Index(expr value)
         assert type(node.ctx) in {ast.Load, ast.Store}
+        if isinstance(node.value, ast.Attribute) and node.value.attr == 'shape':
+            array = node.value.value
+            if not isinstance(array, ast.Name) or not isinstance(node.slice, ast.Index):
+                raise NotImplementedError('shape is only available as name.shape[dim]')
+            return ir.Shape(array.id, self.visit(node.slice.value))
         ref = self.visit(node.value)
         if not isinstance(ref, ir.Ref) or ref.index:
             raise NotImplementedError('Subscripts can only be applied to base names')
@@ -156,12 +162,12 @@ class Frontend(ast.NodeVisitor):
         return ir.If(self.visit(node.test), self.make_block(node.body), self.make_block(node.orelse))
 
     def extract_loop_bounds(self, node):
-        # matches: range(<expr>, <expr>)
+        # matches: range(<expr>, <expr>) or prange(<expr>, <expr>)
         if not isinstance(node, ast.Call):
             raise NotImplementedError('For loop ranges must be given as range(expr, expr)')
         if not isinstance(node.func, ast.Name):
             raise NotImplementedError('For loop ranges must be given as range(expr, expr)')
-        if node.func.id != 'range':
+        if node.func.id not in ('range', 'prange'):
             raise NotImplementedError('For loop ranges must be given as range(expr, expr)')
         if node.keywords:
             raise NotImplementedError('For loop ranges must be given as range(expr, expr)')
@@ -180,7 +186,8 @@ class Frontend(ast.NodeVisitor):
         if node.orelse:
             raise NotImplementedError('Else on for loops not supported')
         low, high = self.extract_loop_bounds(node.iter)
-        return ir.For(var=var.name, min=low, max=high, body=(self.make_block(node.body)))
+        loop = ir.ParallelFor if node.iter.func.id == 'prange' else ir.For
+        return loop(var=var.name, min=low, max=high, body=(self.make_block(node.body)))
 
     def visit_Return(self, node):
         # Return(expr? value)
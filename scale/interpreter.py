@@ -1,16 +1,35 @@
 import ast
+import ctypes
+import functools
+import itertools
+import math
 import operator
 
-from .irtypes import Uop, Bop, Cop
+import numpy
+from llvmlite import ir as llvm
+
+from .irtypes import Uop, Bop, Cop, Ref, FuncCall, Array, Assign, Block, For, Label, Goto
+from .marshalling import MarshalledArg, VectorFunction
+from .typechecker import NDArrayType, TypeChecker
 
 
 class Interpreter(ast.NodeVisitor):
+    """
+    Walks the IR of a function as is. InterpretedFunction is what functions are interpreted
+    with; this stays as the plain reading of the IR to check it against.
+    """
     def __init__(self):
         super().__init__()
         from collections import defaultdict
         self.syms = defaultdict(dict)
         self.cur_fun = None
 
+    @staticmethod
+    def supports(func):
+        indices = {id(node.index) for node in ast.walk(func) if isinstance(node, Ref)}
+        return not any(isinstance(node, (FuncCall, Label, Goto)) or
+                       isinstance(node, Array) and id(node) not in indices for node in ast.walk(func))
+
     @staticmethod
     def visit_str(node):
         return node
@@ -53,10 +72,21 @@ class Interpreter(ast.NodeVisitor):
     def visit_Ref(self, node):
         base = self.syms[self.cur_fun][node.name]
         if node.index:
-            index = self.visit(node.index)
+            base, index = self.index(base, node.index)
             return base[index]
         return base
 
+    def index(self, base, index):
+        # a[i, j] goes through a[i] first, which works for nested lists and ndarrays alike
+        if not isinstance(index, Array):
+            return base, self.visit(index)
+        for i in index.elts[:-1]:
+            base = base[self.visit(i)]
+        return base, self.visit(index.elts[-1])
+
+    def visit_Shape(self, node):
+        return self.syms[self.cur_fun][node.name].shape[self.visit(node.dim)]
+
     def visit_IntConst(self, node):
         return node.val
 
@@ -69,8 +99,8 @@ class Interpreter(ast.NodeVisitor):
     def visit_Assign(self, node):
         val = self.visit(node.val)
         if node.ref.index:
-            index = self.visit(node.ref.index)
-            self.syms[self.cur_fun][node.ref.name][index] = val
+            base, index = self.index(self.syms[self.cur_fun][node.ref.name], node.ref.index)
+            base[index] = val
         else:
             self.syms[self.cur_fun][node.ref.name] = val
 
@@ -98,6 +128,9 @@ class Interpreter(ast.NodeVisitor):
             if val is not None:
                 return val
 
+    # iterations are independent, so running them in order is a valid schedule
+    visit_ParallelFor = visit_For
+
     def visit_Return(self, node):
         return self.visit(node.val)
 
@@ -107,9 +140,490 @@ class Interpreter(ast.NodeVisitor):
     def visit_CastToInt(self, node):
         return int(self.visit(node.expr))
 
+    def visit_Cast(self, node):
+        # wraps around like the native conversion
+        ctype = {'int8': ctypes.c_int8, 'uint8': ctypes.c_uint8, 'int16': ctypes.c_int16,
+                 'int64': ctypes.c_int64, 'float32': ctypes.c_float}[node.to]
+        value = self.visit(node.expr)
+        return ctype(value if node.to == 'float32' else int(value)).value
+
     def call_fun(self, node, *args):
         for name, value in zip(node.args, args):
             self.syms[self.cur_fun][name] = value
         ret = self.visit(node.body)
         return ret
 
+
+
+def _int_range(typ):
+    if typ.width == 1 or TypeChecker.is_unsigned(typ):
+        return 0, (1 << typ.width) - 1
+    return -(1 << typ.width - 1), (1 << typ.width - 1) - 1
+
+def _wrap_int(value, typ):
+    low, high = _int_range(typ)
+    value = (value - low) % (high - low + 1) + low
+    return value == 1 if typ.width == 1 else value
+
+def _f32(x):
+    return ctypes.c_float(x).value
+
+def _fdiv(a, b):
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a != a or a == 0:
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+def _frem(a, b):
+    try:
+        return math.fmod(a, b)
+    except ValueError:
+        return math.nan
+
+def _srem(a, b):
+    # C's remainder takes the sign of the dividend
+    r = abs(a) % abs(b)
+    return -r if a < 0 else r
+
+def _vdiv(a, b):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.true_divide(a, b)
+
+def _vmod(a, b):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.fmod(a, b)
+
+def _vload(array, index, count, dtype):
+    return numpy.array(array[index:index + count], dtype)
+
+def _vstore(array, index, vector):
+    array[index:index + len(vector)] = vector.tolist()
+
+def _lane(vector, index, value):
+    # vectors are values; setting a lane makes a new one
+    vector = vector.copy()
+    vector[index] = value
+    return vector
+
+_helpers = {
+    '_np': numpy, '_f32': _f32, '_fdiv': _fdiv, '_frem': _frem, '_srem': _srem,
+    '_vdiv': _vdiv, '_vmod': _vmod, '_vload': _vload, '_vstore': _vstore, '_lane': _lane,
+}
+
+
+class _Jump(object):
+    """What a goto hands up through the statements around it, to the block holding its label"""
+    __slots__ = ['label']
+
+    def __init__(self, label):
+        self.label = label
+
+
+class ClosureCompiler(ast.NodeVisitor):
+    """
+    Compiles a typechecked function to Python for InterpretedFunction. Locals live in a list
+    of slots, one per name. Expressions are visited into Python source; statements become
+    lines of generated functions, and statements holding labels or gotos closures around
+    them, which return either the function's result or the _Jump of a goto.
+    """
+    symbols = {Bop.Add: '+', Bop.Sub: '-', Bop.Mul: '*', Cop.EQ: '==', Cop.NE: '!=',
+               Cop.LT: '<', Cop.GT: '>', Cop.LE: '<=', Cop.GE: '>='}
+
+    def __init__(self, func, resolve):
+        self.func = func
+        self.resolve = resolve
+        self.namespace = dict(_helpers)
+        self.slots = {}
+        self.constants = {}
+        self.jumps = {}
+        # labels of the blocks around the statement being compiled
+        self.labels = []
+        self.temps = itertools.count()
+        self.types = dict(zip(func.args, func.signature.args))
+        # arrays that may come from NumPy, whose elements are loaded as Python scalars
+        self.foreign = set(func.args)
+        for name in func.args:
+            self.slot(name)
+        for node in ast.walk(func.body) if func.body else ():
+            if isinstance(node, Assign) and node.ref.index is None:
+                self.types.setdefault(node.ref.name, node.val.type)
+                if not isinstance(node.val, Array) and (not isinstance(node.val, FuncCall) or
+                                                        node.val.name == 'select'):
+                    self.foreign.add(node.ref.name)
+            elif isinstance(node, For):
+                self.types[node.var] = TypeChecker.int_type
+
+    def compile(self):
+        body = self.func.body
+        if body is None:
+            lines = ['pass']
+        elif self.jumps_in(body):
+            lines = ['return {}(f)'.format(self.constant(self.closure(body)))]
+        else:
+            lines = self.emit(body)
+        params = ['a{}'.format(i) for i in range(len(self.func.args))]
+        frame = 'f = [{}]'.format(', '.join(params + ['None'] * (len(self.slots) - len(params))))
+        return self.function([frame] + lines, ', '.join(params))
+
+    def slot(self, name):
+        if name not in self.slots:
+            self.slots[name] = len(self.slots)
+        return self.slots[name]
+
+    def constant(self, value):
+        key = id(value)
+        if key not in self.constants:
+            self.constants[key] = '_k{}'.format(len(self.constants))
+            self.namespace[self.constants[key]] = value
+        return self.constants[key]
+
+    def jump(self, label):
+        if label not in self.jumps:
+            self.jumps[label] = _Jump(label)
+        return self.jumps[label]
+
+    def function(self, lines, params='f'):
+        source = 'def _scale({}):\n'.format(params) + '\n'.join('    ' + line for line in lines) + '\n'
+        scope = {}
+        exec(compile(source, '<scale {}>'.format(self.func.name), 'exec'), self.namespace, scope)
+        return scope['_scale']
+
+    @staticmethod
+    def jumps_in(node):
+        return any(isinstance(n, (Label, Goto)) for n in ast.walk(node))
+
+    @staticmethod
+    def flatten(block):
+        # the frontend gives each goto, label and escaped statement list a block of its own
+        for stmt in block.body:
+            if isinstance(stmt, Block):
+                yield from ClosureCompiler.flatten(stmt)
+            else:
+                yield stmt
+
+    @staticmethod
+    def indent(lines):
+        return ['    ' + line for line in lines]
+
+    def dtype(self, typ):
+        return self.constant(MarshalledArg.dtype(typ))
+
+    def wrap(self, src, typ):
+        # integers wrap around at their width, as in C
+        if typ.width == 1:
+            return '((({}) & 1) == 1)'.format(src)
+        mask = (1 << typ.width) - 1
+        if TypeChecker.is_unsigned(typ):
+            return '(({}) & {})'.format(src, mask)
+        half = 1 << typ.width - 1
+        return '(((({}) + {}) & {}) - {})'.format(src, half, mask, half)
+
+    def convert(self, src, typ, to):
+        # the conversions Backend.convert makes, on Python values; NumPy broadcasts scalars
+        if typ == to and TypeChecker.is_unsigned(typ) == TypeChecker.is_unsigned(to):
+            return src
+        if TypeChecker.is_vector(to):
+            if not TypeChecker.is_vector(typ):
+                return self.convert(src, typ, to.element)
+            return '{}.astype({})'.format(src, self.dtype(to.element))
+        if TypeChecker.is_floating(to):
+            return '{}({})'.format('_f32' if to == TypeChecker.float32_type else 'float', src)
+        if TypeChecker.is_floating(typ):
+            return self.wrap('int({})'.format(src), to)
+        low, high = _int_range(typ)
+        to_low, to_high = _int_range(to)
+        if to.width > 1 and to_low <= low and high <= to_high:
+            return 'int({})'.format(src) if typ.width == 1 else src
+        return self.wrap(src, to)
+
+    def scalar(self, src, typ):
+        # NumPy arrays hand out NumPy scalars, which neither wrap nor promote as C does
+        if isinstance(typ, (llvm.PointerType, llvm.VectorType)):
+            return src
+        if TypeChecker.is_floating(typ):
+            return 'float({})'.format(src)
+        return '{}({})'.format('bool' if typ == TypeChecker.bool_type else 'int', src)
+
+    def indices(self, index):
+        return [self.visit(i) for i in (index.elts if isinstance(index, Array) else [index])]
+
+    # statements without labels or gotos, as lines of Python
+
+    def emit(self, node):
+        return getattr(self, 'emit_' + type(node).__name__)(node)
+
+    def emit_body(self, node):
+        return self.emit(node) if node is not None else ['pass']
+
+    def emit_Block(self, node):
+        return [line for stmt in self.flatten(node) for line in self.emit(stmt)] or ['pass']
+
+    def emit_Assign(self, node):
+        ref = node.ref
+        val = self.visit(node.val)
+        base = 'f[{}]'.format(self.slot(ref.name))
+        if ref.index is None:
+            return ['{} = {}'.format(base, val)]
+        typ = self.types[ref.name]
+        if TypeChecker.is_vector(typ):
+            return ['{0} = _lane({0}, {1}, {2})'.format(base, self.visit(ref.index), val)]
+        indices = self.indices(ref.index)
+        if isinstance(typ, NDArrayType):
+            return ['{}[{}] = {}'.format(base, ', '.join(indices), val)]
+        if TypeChecker.is_vector(node.val.type):
+            # a[i] = v stores the lanes of v to a[i:i + len(v)]
+            return ['_vstore({}, {}, {})'.format(base, indices[0], val)]
+        return ['{}{} = {}'.format(base, ''.join('[{}]'.format(i) for i in indices), val)]
+
+    def emit_Return(self, node):
+        return ['return ' + self.visit(node.val)]
+
+    def emit_If(self, node):
+        lines = ['if {}:'.format(self.visit(node.cond))] + self.indent(self.emit_body(node.body))
+        if node.else_body is not None:
+            lines += ['else:'] + self.indent(self.emit(node.else_body))
+        return lines
+
+    def emit_For(self, node):
+        k = self.slot(node.var)
+        t = next(self.temps)
+        lines = ['_lo{} = {}'.format(t, self.visit(node.min)), '_hi{} = {}'.format(t, self.visit(node.max))]
+        body = self.indent(self.emit_body(node.body))
+        if any(isinstance(n, Assign) and n.ref.name == node.var and n.ref.index is None
+               for n in ast.walk(node.body)):
+            # the body moves the loop variable, so it is counted as the native loop counts it
+            return lines + ['f[{}] = _lo{}'.format(k, t), 'while f[{}] < _hi{}:'.format(k, t)] + body + \
+                ['    f[{0}] = f[{0}] + 1'.format(k)]
+        return lines + ['for f[{}] in range(_lo{}, _hi{}):'.format(k, t, t)] + body + \
+            ['f[{0}] = _hi{1} if _lo{1} < _hi{1} else _lo{1}'.format(k, t)]
+
+    # iterations are independent, so running them in order is a valid schedule
+    emit_ParallelFor = emit_For
+
+    # statements holding labels or gotos, as closures
+
+    def closure(self, node):
+        if not self.jumps_in(node):
+            return self.function(self.emit(node))
+        return getattr(self, 'closure_' + type(node).__name__)(node)
+
+    def closure_Block(self, node):
+        stmts = []
+        targets = {}
+        run = []
+        self.labels.append({stmt.name for stmt in self.flatten(node) if isinstance(stmt, Label)})
+        for stmt in self.flatten(node):
+            if not self.jumps_in(stmt):
+                # straight runs of statements become one generated function
+                run.append(stmt)
+                continue
+            if run:
+                stmts.append(self.function([line for s in run for line in self.emit(s)]))
+                run = []
+            if isinstance(stmt, Label):
+                targets[self.jump(stmt.name)] = len(stmts)
+            else:
+                stmts.append(self.closure(stmt))
+        if run:
+            stmts.append(self.function([line for s in run for line in self.emit(s)]))
+        self.labels.pop()
+        stmts = tuple(stmts)
+        count = len(stmts)
+
+        def block(f):
+            pc = 0
+            while pc < count:
+                r = stmts[pc](f)
+                pc += 1
+                if r is not None:
+                    if r.__class__ is not _Jump or r not in targets:
+                        return r
+                    pc = targets[r]
+        return block
+
+    def closure_If(self, node):
+        cond = self.function(['return ' + self.visit(node.cond)])
+        body = self.closure(node.body) if node.body is not None else None
+        else_body = self.closure(node.else_body) if node.else_body is not None else None
+
+        def branch(f):
+            if cond(f):
+                if body is not None:
+                    return body(f)
+            elif else_body is not None:
+                return else_body(f)
+        return branch
+
+    def closure_For(self, node):
+        k = self.slot(node.var)
+        low = self.function(['return ' + self.visit(node.min)])
+        high = self.function(['return ' + self.visit(node.max)])
+        body = self.closure(node.body)
+
+        def loop(f):
+            lo = low(f)
+            hi = high(f)
+            f[k] = lo
+            while f[k] < hi:
+                r = body(f)
+                if r is not None:
+                    return r
+                f[k] += 1
+        return loop
+
+    closure_ParallelFor = closure_For
+
+    def closure_Goto(self, node):
+        if not any(node.name in labels for labels in self.labels):
+            raise NotImplementedError('goto {} does not jump to a label of an enclosing block'.format(node.name))
+        jump = self.jump(node.name)
+        return lambda f: jump
+
+    # expressions, as Python source
+
+    def visit_IntConst(self, node):
+        value = _wrap_int(node.val, node.type)
+        return '({})'.format(value) if value < 0 else str(value)
+
+    def visit_FloatConst(self, node):
+        return repr(node.val) if math.isfinite(node.val) else self.constant(node.val)
+
+    def visit_BoolConst(self, node):
+        return repr(bool(node.val))
+
+    def visit_Ref(self, node):
+        base = 'f[{}]'.format(self.slot(node.name))
+        if node.index is None:
+            return base
+        typ = self.types[node.name]
+        if TypeChecker.is_vector(typ):
+            return '{}.item({})'.format(base, self.visit(node.index))
+        indices = self.indices(node.index)
+        if isinstance(typ, NDArrayType):
+            return self.scalar('{}[{}]'.format(base, ', '.join(indices)), node.type)
+        src = base + ''.join('[{}]'.format(i) for i in indices)
+        return self.scalar(src, node.type) if node.name in self.foreign else src
+
+    def visit_Shape(self, node):
+        return 'f[{}].shape[{}]'.format(self.slot(node.name), self.visit(node.dim))
+
+    def visit_UnOp(self, node):
+        src = self.visit(node.e)
+        vector = TypeChecker.is_vector(node.type)
+        if node.op == Uop.Not:
+            return '(~{})'.format(src) if vector else '(not {})'.format(src)
+        src = self.convert(src, node.e.type, node.type)
+        if TypeChecker.is_integer(node.type) and not vector:
+            return self.wrap('-' + src, node.type)
+        return '(-{})'.format(src)
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if node.op in (Bop.And, Bop.Or):
+            # both yield one of their operands, as the native phi does
+            return '({} {} {})'.format(left, 'and' if node.op == Bop.And else 'or', right)
+        if TypeChecker.is_vector(node.type):
+            if node.op in (Bop.Div, Bop.Mod):
+                return '{}({}, {})'.format('_vdiv' if node.op == Bop.Div else '_vmod', left, right)
+            return '({} {} {})'.format(left, self.symbols[node.op], right)
+        left = self.convert(left, node.left.type, node.type)
+        right = self.convert(right, node.right.type, node.type)
+        floating = TypeChecker.is_floating(node.type)
+        if node.op == Bop.Div:
+            src = '_fdiv({}, {})'.format(left, right)
+        elif node.op == Bop.Mod:
+            src = '{}({}, {})'.format('_frem' if floating else '_srem', left, right)
+            if not floating and node.type.width > 1:
+                return src
+        else:
+            src = '({} {} {})'.format(left, self.symbols[node.op], right)
+        if node.type == TypeChecker.float32_type:
+            return '_f32({})'.format(src)
+        return src if floating else self.wrap(src, node.type)
+
+    def visit_CmpOp(self, node):
+        left = self.convert(self.visit(node.left), node.left.type, node.operand_type)
+        right = self.convert(self.visit(node.right), node.right.type, node.operand_type)
+        return '({} {} {})'.format(left, self.symbols[node.op], right)
+
+    def visit_CastToFloat(self, node):
+        return self.convert(self.visit(node.expr), node.expr.type, node.type)
+
+    visit_CastToInt = visit_Cast = visit_CastToFloat
+
+    def visit_Array(self, node):
+        return '[{}]'.format(', '.join(map(self.visit, node.elts)))
+
+    def visit_FuncCall(self, node):
+        args = [self.visit(arg) for arg in node.args]
+        if node.name in TypeChecker.array_constructors:
+            element = node.type.pointee
+            zero = '0.0' if TypeChecker.is_floating(element) else 'False' if element.width == 1 else '0'
+            return '([{}] * {})'.format(zero, args[0])
+        if node.name in TypeChecker.vector_types:
+            vtype = node.type
+            if node.kind == 'load':
+                return '_vload({}, {}, {}, {})'.format(args[0], args[1], vtype.count, self.dtype(vtype.element))
+            lanes = [self.convert(arg, a.type, vtype.element) for arg, a in zip(args, node.args)]
+            if node.kind == 'splat':
+                return '_np.full({}, {}, {})'.format(vtype.count, lanes[0], self.dtype(vtype.element))
+            return '_np.array([{}], {})'.format(', '.join(lanes), self.dtype(vtype.element))
+        if node.name == 'select':
+            cond, left, right = node.args
+            left_src = self.convert(args[1], left.type, node.type)
+            right_src = self.convert(args[2], right.type, node.type)
+            if TypeChecker.is_vector(cond.type):
+                return '_np.where({}, {}, {}).astype({})'.format(args[0], left_src, right_src,
+                                                                 self.dtype(node.type.element))
+            return '({} if {} else {})'.format(left_src, args[0], right_src)
+        callee = self.resolve(node.name)
+        name = self.constant(callee)
+        if isinstance(callee, InterpretedFunction):
+            # looked up on each call, as a callee that calls back is compiled after its caller
+            name += '.run'
+        return '{}({})'.format(name, ', '.join(args))
+
+
+class InterpretedFunction(object):
+    """
+    A typechecked function compiled once to Python by ClosureCompiler, which runs it as the
+    native code would: integers wrap at their width, int8 to int64 and uint8 included, and
+    float32 results are rounded to single precision. Arrays are passed in place; the array
+    a function returns comes back as a NumPy array. Calls to other functions go to what
+    resolve(name) gives for them: an InterpretedFunction, or a native function.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.signature = func.signature
+        self.converters = [self.converter(typ) for typ in self.signature.args]
+        ret = self.signature.return_type
+        self.result_dtype = MarshalledArg.dtype(ret.pointee) if isinstance(ret, llvm.PointerType) else None
+
+    def compile(self, resolve):
+        # run takes arguments already converted, as calls from other interpreted functions do
+        self.run = ClosureCompiler(self.func, resolve).compile()
+        return self
+
+    @staticmethod
+    def converter(typ):
+        if TypeChecker.is_vector(typ):
+            return functools.partial(VectorFunction.lanes, vector_type=typ)
+        if isinstance(typ, llvm.PointerType):
+            return None
+        if TypeChecker.is_floating(typ):
+            return _f32 if typ == TypeChecker.float32_type else float
+        if typ == TypeChecker.bool_type:
+            return bool
+        return lambda value: _wrap_int(int(value), typ)
+
+    def __call__(self, *args):
+        if len(args) != len(self.converters):
+            raise TypeError('expected {} arguments, got {}'.format(len(self.converters), len(args)))
+        result = self.run(*[arg if convert is None else convert(arg)
+                            for arg, convert in zip(args, self.converters)])
+        if self.result_dtype is not None:
+            return numpy.array(result, self.result_dtype)
+        return result
@@ -10,6 +10,8 @@ Expr = BinOp(Bop op, Expr left, Expr right)
      | IntConst(int val)
      | FuncCall(Str name, Expr* args)
      | Array(Expr* elts)
+     | Cast(Str to, Expr expr)
+     | Shape(Str name, Expr dim)
 
 Uop = Neg | Not
 Bop = Add | Sub | Mul | Div | Mod | And | Or
@@ -19,6 +21,7 @@ Stmt = Assign(Ref ref, Expr val)
      | Block(Stmt* body)
      | If(Expr cond, Stmt body, Stmt? elseBody)
      | For(Str var, Expr min, Expr max, Stmt body)
+     | ParallelFor(Str var, Expr min, Expr max, Stmt body)
      | Return(Expr val)
      | FuncDef(Str name, Str* args, Stmt body)
      | Label(Str name)
@@ -86,6 +89,11 @@ class Ref(ast.AST):
         super().__init__(name, index, *args, **kwargs)
 
 
+class Shape(ast.AST):
+    """The extent of an ndarray along dimension dim"""
+    _fields = ['name', 'dim']
+
+
 class CastToFloat(ast.AST):
     """Promotes an int type to a float type"""
     _fields = ['expr']
@@ -96,6 +104,11 @@ class CastToInt(ast.AST):
     _fields = ['expr']
 
 
+class Cast(ast.AST):
+    """Converts to the scalar type named by to"""
+    _fields = ['to', 'expr']
+
+
 class Return(ast.AST):
     _fields = ['val', ]
 
@@ -115,6 +128,10 @@ class For(ast.AST):
     _fields = ['var', 'min', 'max', 'body']
 
 
+class ParallelFor(For):
+    """A For whose iterations are independent and may run concurrently"""
+
+
 class Block(ast.AST):
     _fields = ['body', ]
 
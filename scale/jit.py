@@ -0,0 +1,149 @@
+import collections
+import threading
+import weakref
+
+import llvmlite.binding as binding
+
+
+class JITModule(object):
+    """
+    Object code of one function loaded into an MCJIT engine of its own, so its code memory
+    can be released by closing the engine and the object loaded again when it is next called.
+    """
+    def __init__(self, obj, name, create_engine, space):
+        self.obj = obj
+        self.name = name
+        self.size = len(obj)
+        self.create_engine = create_engine
+        self.space = space
+        self.engine = None
+        self.native = None
+        self.cfunc = None
+        # calls currently running this module's code; it is never evicted under them
+        self.active = 0
+
+    @property
+    def loaded(self):
+        return self.engine is not None
+
+    def load(self):
+        with self.space.lock:
+            if self.engine is None:
+                engine = self.create_engine()
+                engine.add_object_file(binding.ObjectFileRef.from_data(self.obj))
+                engine.finalize_object()
+                self.engine = engine
+                self.space.loaded(self)
+                self.rebind()
+            return self.engine.get_function_address(self.name)
+
+    def global_address(self, name):
+        with self.space.lock:
+            self.load()
+            return self.engine.get_global_value_address(name)
+
+    def unload(self):
+        with self.space.lock:
+            if self.engine is None:
+                return
+            native = self.native() if self.native is not None else None
+            if native is not None:
+                native.cfunc = self.call
+            self.cfunc = None
+            self.engine.close()
+            self.engine = None
+            self.space.unloaded(self)
+
+    def attach(self, native):
+        self.native = weakref.ref(native)
+        self.rebind()
+
+    def rebind(self):
+        native = self.native() if self.native is not None else None
+        if native is None or self.engine is None:
+            return
+        native.func_ptr = self.engine.get_function_address(self.name)
+        self.cfunc = native.prototype(native.func_ptr)
+        # recency and in-flight calls only matter once there is a budget to enforce
+        native.cfunc = self.call if self.space.max_size is not None else self.cfunc
+
+    def call(self, *args):
+        with self.space.lock:
+            self.load()
+            self.space.touch(self)
+            self.active += 1
+            cfunc = self.cfunc
+        try:
+            return cfunc(*args)
+        finally:
+            with self.space.lock:
+                self.active -= 1
+                # loads that happened while this call ran may have left the space over budget
+                self.space.evict()
+
+    def __del__(self):
+        self.unload()
+
+
+class CodeSpace(object):
+    """
+    Loaded JIT modules, least recently used first. Once their object code exceeds max_size
+    bytes, the least recently used ones that are not running are unloaded until the total
+    fits again.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.modules = collections.OrderedDict()
+        self.size = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def loaded(self, module):
+        with self.lock:
+            # weak, so dropping the last reference to a function still releases its code
+            self.modules[id(module)] = weakref.ref(module)
+            self.size += module.size
+            self.loads += 1
+            self.evict(keep=module)
+
+    def unloaded(self, module):
+        with self.lock:
+            if self.modules.pop(id(module), None) is not None:
+                self.size -= module.size
+
+    def touch(self, module):
+        with self.lock:
+            if id(module) in self.modules:
+                self.modules.move_to_end(id(module))
+
+    def evict(self, keep=None):
+        with self.lock:
+            if self.max_size is None:
+                return
+            for ref in list(self.modules.values()):
+                if self.size <= self.max_size:
+                    break
+                module = ref()
+                if module is not None and module is not keep and not module.active:
+                    module.unload()
+                    self.evictions += 1
+
+    def set_max_size(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            for ref in list(self.modules.values()):
+                module = ref()
+                if module is not None:
+                    module.rebind()
+            self.evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'modules': len(self.modules),
+                'size': self.size,
+                'max_size': self.max_size,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
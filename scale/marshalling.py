@@ -1,9 +1,11 @@
+import contextlib
 import ctypes
+import itertools
 
 import numpy
 from llvmlite import ir as llvm
 
-from .typechecker import TypeChecker
+from .typechecker import NDArrayType, TypeChecker, UnsignedIntType
 
 
 class MarshalledArg(object):
@@ -12,6 +14,10 @@ class MarshalledArg(object):
         self.llvm_ty = llvm_ty
 
         self.copy_back = False
+        self.intent = TypeChecker.intent(llvm_ty)
+        # what the pointer passed points into, kept alive for the call
+        self.buffers = []
+        self.lists = None
         self.ctype = MarshalledArg.to_ctype(llvm_ty)
         self._as_parameter_ = self.wrap_value(py_arg)
 
@@ -19,50 +25,319 @@ class MarshalledArg(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.copy_back:
-            if isinstance(self.py_arg, list):
-                for i in range(len(self.py_arg)):
-                    self.py_arg[i] = self._as_parameter_[i]
+        if self.copy_back and self.lists is not None:
+            values = self.buffers[0].tolist()
+            start = 0
+            for values_list in self.lists:
+                end = start + len(values_list)
+                values_list[:] = values[start:end]
+                start = end
+
+    int_ctypes = {8: ctypes.c_int8, 16: ctypes.c_int16, 32: ctypes.c_int32, 64: ctypes.c_int64}
+    # NumPy dtypes passed without copying as arrays of each scalar type
+    dtype_types = {
+        numpy.dtype(numpy.int8): TypeChecker.int8_type,
+        numpy.dtype(numpy.uint8): TypeChecker.uint8_type,
+        numpy.dtype(numpy.int16): TypeChecker.int16_type,
+        numpy.dtype(numpy.int32): TypeChecker.int_type,
+        numpy.dtype(numpy.int64): TypeChecker.int64_type,
+        numpy.dtype(numpy.float32): TypeChecker.float32_type,
+        numpy.dtype(numpy.float64): TypeChecker.float_type,
+    }
 
     @staticmethod
     def to_ctype(ir_type, in_ptr=False):
+        if isinstance(ir_type, llvm.VoidType):
+            return None
+        if isinstance(ir_type, UnsignedIntType) and ir_type.width == 8:
+            return ctypes.c_uint8
         if isinstance(ir_type, llvm.IntType):
-            if ir_type.width == 32:
-                return ctypes.c_int32
             if ir_type.width == 1:
                 return ctypes.c_char
+            if ir_type.width in MarshalledArg.int_ctypes:
+                return MarshalledArg.int_ctypes[ir_type.width]
+        if isinstance(ir_type, llvm.FloatType):
+            return ctypes.c_float
         if isinstance(ir_type, llvm.DoubleType):
             return ctypes.c_double
+        if isinstance(ir_type, NDArrayType):
+            return ctypes.POINTER(MarshalledArg.descriptor(ir_type))
         if isinstance(ir_type, llvm.PointerType):
             return ctypes.POINTER(MarshalledArg.to_ctype(ir_type.pointee, in_ptr=True))
         raise NotImplementedError('No ctype available for {}'.format(ir_type))
 
+    descriptors = {}
+
+    @staticmethod
+    def descriptor(ndarray_type):
+        # laid out as NDArrayType.pointee
+        element = MarshalledArg.to_ctype(ndarray_type.element)
+        key = (element, ndarray_type.ndim)
+        if key not in MarshalledArg.descriptors:
+            index = ctypes.c_int64 * ndarray_type.ndim
+            MarshalledArg.descriptors[key] = type('ndarray_descriptor', (ctypes.Structure,), {
+                '_fields_': [('data', ctypes.POINTER(element)), ('shape', index), ('strides', index)]})
+        return MarshalledArg.descriptors[key]
+
+    @staticmethod
+    def dtype(ir_type):
+        el_ty = MarshalledArg.to_ctype(ir_type)
+        # bools are stored a byte each, as in NumPy
+        return numpy.dtype(numpy.bool_ if el_ty == ctypes.c_char else el_ty)
+
+    def wrap_ndarray(self, arg):
+        el_ty = self.to_ctype(self.llvm_ty.element)
+        dtype = self.dtype(self.llvm_ty.element)
+        if not isinstance(arg, numpy.ndarray):
+            raise NotImplementedError('Passing {} as an ndarray'.format(type(arg)))
+        if arg.dtype != dtype:
+            raise ValueError('expected {} ndarray, got {}'.format(dtype, arg.dtype))
+        if arg.ndim != self.llvm_ty.ndim:
+            raise ValueError('expected {}-dimensional ndarray, got {}'.format(self.llvm_ty.ndim, arg.ndim))
+        if any(stride % dtype.itemsize for stride in arg.strides):
+            raise ValueError('ndarray strides must be multiples of its itemsize')
+        index = ctypes.c_int64 * arg.ndim
+        desc = self.descriptor(self.llvm_ty)(arg.ctypes.data_as(ctypes.POINTER(el_ty)), index(*arg.shape),
+                                             index(*[stride // dtype.itemsize for stride in arg.strides]))
+        # the descriptor holds a reference to the array, which outlives the call with it
+        desc.array = arg
+        return ctypes.pointer(desc)
+
+    def wrap_buffer(self, view, dtype):
+        # array.array, bytearray, mmap and the like are passed in place when their format matches
+        try:
+            matches = numpy.dtype(view.format) == dtype
+        except TypeError:
+            matches = False
+        if not matches:
+            raise ValueError('expected buffer of {}, got format {!r}'.format(dtype, view.format))
+        if not view.c_contiguous:
+            raise ValueError('buffer must be C-contiguous')
+        if view.readonly and self.intent != 'In':
+            raise ValueError('buffer is read-only')
+        array = numpy.asarray(view)
+        self.buffers.append(array)
+        return array.ctypes.data_as(self.ctype)
+
+    def wrap_list(self, arg):
+        # levels[k] holds the lists k pointers deep; the values of the last are copied into
+        # one buffer, and each level above becomes a table of pointers into the one below
+        levels = [[arg]]
+        pointee = self.llvm_ty.pointee
+        while isinstance(pointee, llvm.PointerType):
+            levels.append(list(itertools.chain.from_iterable(levels[-1])))
+            pointee = pointee.pointee
+        if self.intent == 'Out':
+            # only written by the function, so the values are left out
+            target = numpy.zeros(sum(map(len, levels[-1])), self.dtype(pointee))
+        else:
+            values = levels[-1][0] if len(levels) == 1 else list(itertools.chain.from_iterable(levels[-1]))
+            target = numpy.array(values, self.dtype(pointee))
+        self.buffers.append(target)
+        for lists in reversed(levels[1:]):
+            lengths = numpy.fromiter(map(len, lists), numpy.uintp, len(lists))
+            target = (numpy.cumsum(lengths) - lengths) * numpy.uintp(target.itemsize) + numpy.uintp(target.ctypes.data)
+            self.buffers.append(target)
+        self.lists = levels[-1]
+        return ctypes.cast(target.ctypes.data, self.ctype)
+
+    @staticmethod
+    def infer_type(arg):
+        if isinstance(arg, (bool, numpy.bool_)):
+            return TypeChecker.bool_type
+        if isinstance(arg, int):
+            return TypeChecker.int_type
+        if isinstance(arg, float):
+            return TypeChecker.float_type
+        if isinstance(arg, numpy.generic) and arg.dtype in MarshalledArg.dtype_types:
+            return MarshalledArg.dtype_types[arg.dtype]
+        if isinstance(arg, numpy.ndarray):
+            if arg.dtype in MarshalledArg.dtype_types:
+                return llvm.PointerType(MarshalledArg.dtype_types[arg.dtype])
+            raise TypeError('no Scale type for ndarray of {}'.format(arg.dtype))
+        if isinstance(arg, list):
+            if not arg:
+                raise TypeError('cannot infer the element type of an empty list')
+            return llvm.PointerType(MarshalledArg.infer_type(arg[0]))
+        try:
+            dtype = numpy.dtype(memoryview(arg).format)
+        except (TypeError, ValueError):
+            pass
+        else:
+            if dtype in MarshalledArg.dtype_types:
+                return llvm.PointerType(MarshalledArg.dtype_types[dtype])
+        raise TypeError('no Scale type for {}'.format(type(arg).__name__))
+
     def wrap_value(self, arg, helper=None):
         if helper == None:
             helper = self.llvm_ty
 
-        if helper == TypeChecker.int_type and isinstance(arg, int):
+        if TypeChecker.is_integer(helper) and isinstance(arg, int):
             return arg
         if helper == TypeChecker.bool_type and isinstance(arg, bool):
             return arg
-        if helper == TypeChecker.float_type and isinstance(arg, float):
+        if TypeChecker.is_floating(helper) and isinstance(arg, float):
             return arg
+        if isinstance(self.llvm_ty, NDArrayType):
+            return self.wrap_ndarray(arg)
         if isinstance(self.llvm_ty, llvm.PointerType):
-            el_ty = self.to_ctype(self.llvm_ty.pointee)
-            self.copy_back = True
+            # the function never writes to an In array, so there is nothing to copy back
+            self.copy_back = self.intent != 'In'
             if isinstance(arg, list):
-                if isinstance(arg[0], list):
-                    return ctypes.cast((self.to_ctype(helper.pointee)*len(arg))(*[self.wrap_value(i, helper.pointee) for i in arg]), self.to_ctype(helper))
-                return ctypes.cast((self.to_ctype(helper.pointee) * len(arg))(*arg), self.to_ctype(helper))
-            elif isinstance(arg, numpy.ndarray):
-                if el_ty == ctypes.c_double and arg.dtype != numpy.double:
-                    raise ValueError('expected double ndarray, got {}'.format(arg.dtype))
-                elif el_ty == ctypes.c_int32 and arg.dtype != numpy.int32:
-                    raise ValueError('expected int32 ndarray, got {}'.format(arg.dtype))
-                elif el_ty == ctypes.c_bool:
-                    raise NotImplementedError('arrays of bools')
+                return self.wrap_list(arg)
+            if isinstance(helper.pointee, llvm.PointerType):
+                raise NotImplementedError('Passing {} to arrays of arrays'.format(type(arg)))
+            dtype = self.dtype(helper.pointee)
+            if isinstance(arg, numpy.ndarray):
+                if arg.dtype != dtype:
+                    raise ValueError('expected {} ndarray, got {}'.format(dtype, arg.dtype))
                 return arg.ctypes.data_as(self.ctype)
-            else:
+            try:
+                view = memoryview(arg)
+            except TypeError:
                 raise NotImplementedError('Passing {} to c arrays'.format(type(arg)))
+            return self.wrap_buffer(view, dtype)
         raise NotImplementedError('Not sure how to handle arguments of type {}'.format(type(arg)))
 
+
+_libc = ctypes.CDLL(None)
+_libc.free.argtypes = [ctypes.c_void_p]
+_capsule_new = ctypes.pythonapi.PyCapsule_New
+_capsule_new.restype = ctypes.py_object
+_capsule_new.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+_capsule_pointer = ctypes.pythonapi.PyCapsule_GetPointer
+_capsule_pointer.restype = ctypes.c_void_p
+_capsule_pointer.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+_capsule_name = b'scale.array'
+
+@ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+def _free_capsule(capsule):
+    _libc.free(_capsule_pointer(capsule, _capsule_name))
+
+def owned_array(address, dtype):
+    """
+    The NumPy array over an array a Scale function returned, which owns it: the element count
+    is in the 16 bytes before it, and the block is freed once no view of it is left.
+    """
+    if not address:
+        raise MemoryError('a Scale function failed to allocate the array it returns')
+    block = address - 16
+    count = ctypes.c_int64.from_address(block).value
+    buf = (ctypes.c_char * (count * dtype.itemsize)).from_address(address)
+    buf.owner = _capsule_new(block, _capsule_name, ctypes.cast(_free_capsule, ctypes.c_void_p).value)
+    return numpy.frombuffer(buf, dtype)
+
+
+class NativeFunction(object):
+    """
+    Calls a compiled function through a ctypes signature built once from its LLVM signature.
+    """
+    def __init__(self, func, func_ptr):
+        self.arg_types = [arg.type for arg in func.args]
+        ret = func.return_value.type
+        # arrays come back as their address, and are handed to NumPy
+        self.result_dtype = MarshalledArg.dtype(ret.pointee) if isinstance(ret, llvm.PointerType) else None
+        self.ret_type = ctypes.c_void_p if self.result_dtype is not None else MarshalledArg.to_ctype(ret)
+        arg_ctypes = [MarshalledArg.to_ctype(arg) for arg in self.arg_types]
+        self.prototype = ctypes.CFUNCTYPE(self.ret_type, *arg_ctypes)
+        self.cfunc = self.prototype(func_ptr)
+        self.pointers = [isinstance(arg, llvm.PointerType) for arg in self.arg_types]
+        self.func_ptr = func_ptr
+
+    def check_arity(self, args):
+        if len(args) != len(self.arg_types):
+            raise TypeError('expected {} arguments, got {}'.format(len(self.arg_types), len(args)))
+
+    def convert_result(self, value):
+        if self.result_dtype is not None:
+            return owned_array(value, self.result_dtype)
+        if self.ret_type == ctypes.c_char:
+            value = value == b'\x01'
+        return value
+
+    def __call__(self, *args):
+        self.check_arity(args)
+        return self.call(args)
+
+    def call(self, args):
+        if not any(self.pointers):
+            return self.convert_result(self.cfunc(*args))
+        with contextlib.ExitStack() as stack:
+            func_args = [stack.enter_context(MarshalledArg(arg, ty)) if pointer else arg
+                         for arg, ty, pointer in zip(args, self.arg_types, self.pointers)]
+            return self.convert_result(self.cfunc(*func_args))
+
+    def bind(self, *args):
+        return PreparedCall(self, args)
+
+
+class VectorFunction(NativeFunction):
+    """
+    Calls a function taking or returning SIMD vectors through its wrapper, which passes each
+    vector as a pointer to its lanes. Vectors are given as sequences of lanes, and a vector
+    result comes back as a NumPy array.
+    """
+    def __init__(self, ftype, wrapper, func_ptr):
+        super(VectorFunction, self).__init__(wrapper, func_ptr)
+        self.vectors = [t if isinstance(t, llvm.VectorType) else None for t in ftype.args]
+        self.result = ftype.return_type if isinstance(ftype.return_type, llvm.VectorType) else None
+
+    @staticmethod
+    def lanes(arg, vector_type):
+        lanes = numpy.ascontiguousarray(arg, numpy.dtype(MarshalledArg.to_ctype(vector_type.element)))
+        if lanes.shape != (vector_type.count,):
+            raise ValueError('expected {} lanes, got shape {}'.format(vector_type.count, lanes.shape))
+        return lanes
+
+    def check_arity(self, args):
+        if len(args) != len(self.vectors):
+            raise TypeError('expected {} arguments, got {}'.format(len(self.vectors), len(args)))
+
+    def __call__(self, *args):
+        self.check_arity(args)
+        args = [arg if vector is None else self.lanes(arg, vector)
+                for arg, vector in zip(args, self.vectors)]
+        if self.result is None:
+            return self.call(args)
+        out = numpy.empty(self.result.count, numpy.dtype(MarshalledArg.to_ctype(self.result.element)))
+        self.call(args + [out])
+        return out
+
+    def bind(self, *args):
+        raise NotImplementedError('prepared calls to functions passing vectors')
+
+
+class PreparedCall(object):
+    """
+    A call with its array arguments marshalled once. Calling it again with the same array
+    objects reuses their buffers, so only the scalar arguments are converted. Lists have no
+    buffer of their own to reuse and are converted on every call.
+    """
+    def __init__(self, native, args):
+        native.check_arity(args)
+        self.native = native
+        self.py_args = [None] * len(args)
+        self.marshalled = [None] * len(args)
+        self.call_args = [None] * len(args)
+        self.update(args)
+
+    def update(self, args):
+        for i, (arg, ty, pointer) in enumerate(zip(args, self.native.arg_types, self.native.pointers)):
+            if not pointer:
+                self.call_args[i] = arg
+            elif arg is not self.py_args[i] or isinstance(arg, list):
+                # a list is copied in again on every call, as its buffer is copied back into it
+                # after each one and would undo the caller's writes in between
+                self.marshalled[i] = MarshalledArg(arg, ty)
+                self.call_args[i] = self.marshalled[i]
+            self.py_args[i] = arg
+
+    def __call__(self, *args):
+        if args:
+            self.native.check_arity(args)
+        self.update(args or list(self.py_args))
+        value = self.native.cfunc(*self.call_args)
+        for marshalled in self.marshalled:
+            if marshalled is not None:
+                marshalled.__exit__(None, None, None)
+        return self.native.convert_result(value)
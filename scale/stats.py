@@ -0,0 +1,42 @@
+import ast
+import contextlib
+import time
+
+import llvmlite.binding as binding
+
+
+class CompileStats(object):
+    """
+    Wall time per compilation phase and size measurements for one Scale function.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
+
+    def as_dict(self):
+        stats = {'name': self.name, 'phases': dict(self.phases)}
+        stats['total_time'] = sum(self.phases.values())
+        stats.update(self.counts)
+        return stats
+
+
+def count_nodes(tree):
+    return sum(1 for _ in ast.walk(tree))
+
+
+def count_instructions(mod):
+    return sum(1 for fn in mod.functions for block in fn.blocks for _ in block.instructions)
+
+
+def machine_code_size(obj):
+    sections = binding.ObjectFileRef.from_data(obj).sections()
+    return sum(section.size() for section in sections if section.is_text())
@@ -1,7 +1,8 @@
 import ast
+import copy
 
 from llvmlite import ir as llvm
-from .irtypes import Bop, Cop, Uop, Assign, Ref
+from .irtypes import Bop, Cop, Uop, Array, Assign, BinOp, FuncCall, Ref, Return, FloatConst, IntConst
 
 def assign(f):
     def wrap(self, node):
@@ -10,10 +11,125 @@ def assign(f):
         return rv
     return wrap
 
+class UnsignedIntType(llvm.IntType):
+    """
+    An integer type read as unsigned. LLVM integers carry no sign, so it prints as the
+    signed type of its width but compares unequal to it.
+    """
+    _instance_cache = {}
+
+    def __eq__(self, other):
+        return isinstance(other, UnsignedIntType) and self.width == other.width
+
+    def __hash__(self):
+        return hash(UnsignedIntType)
+
+class NDArrayType(llvm.PointerType):
+    """
+    A NumPy array, passed as a pointer to a descriptor holding its data pointer, its shape
+    and its strides counted in elements.
+    """
+    def __init__(self, element, ndim):
+        index = llvm.ArrayType(llvm.IntType(64), ndim)
+        super(NDArrayType, self).__init__(llvm.LiteralStructType([element.as_pointer(), index, index]))
+        self.element = element
+        self.ndim = ndim
+
+    def __eq__(self, other):
+        return isinstance(other, NDArrayType) and self.element == other.element and self.ndim == other.ndim
+
+    def __hash__(self):
+        return hash((NDArrayType, self.ndim))
+
 class TypeChecker(ast.NodeVisitor):
     int_type = llvm.IntType(32)
     float_type = llvm.DoubleType()
     bool_type = llvm.IntType(1)
+    int8_type = llvm.IntType(8)
+    uint8_type = UnsignedIntType(8)
+    int16_type = llvm.IntType(16)
+    int64_type = llvm.IntType(64)
+    float32_type = llvm.FloatType()
+    scalar_types = {
+        'bool': bool_type,
+        'int8': int8_type,
+        'uint8': uint8_type,
+        'int16': int16_type,
+        'int': int_type,
+        'int64': int64_type,
+        'float32': float32_type,
+        'float': float_type,
+    }
+    # explicit SIMD vectors; intN is left free for scalar integer widths
+    vector_types = {
+        'float2': llvm.VectorType(float_type, 2),
+        'float4': llvm.VectorType(float_type, 4),
+        'float8': llvm.VectorType(float_type, 8),
+        'int4x': llvm.VectorType(int_type, 4),
+        'int8x': llvm.VectorType(int_type, 8),
+        'int16x': llvm.VectorType(int_type, 16),
+    }
+
+    array_constructors = {
+        'create_int_array': int_type,
+        'create_float_array': float_type,
+        'create_bool_array': bool_type,
+    }
+
+    # In arrays are only read, Out arrays only written; the default is InOut
+    intents = ('In', 'Out', 'InOut')
+
+    @staticmethod
+    def intent(typ):
+        return getattr(typ, 'intent', 'InOut')
+
+    @staticmethod
+    def is_vector(typ):
+        return isinstance(typ, llvm.VectorType)
+
+    @staticmethod
+    def is_floating(typ):
+        return isinstance(TypeChecker.element_type(typ), (llvm.FloatType, llvm.DoubleType))
+
+    @staticmethod
+    def is_integer(typ):
+        typ = TypeChecker.element_type(typ)
+        return isinstance(typ, llvm.IntType) and typ.width > 1
+
+    @staticmethod
+    def is_unsigned(typ):
+        return isinstance(TypeChecker.element_type(typ), UnsignedIntType)
+
+    @staticmethod
+    def arith_type(left, right):
+        # C's usual arithmetic conversions: the wider float wins over any integer, and
+        # integers narrower than int are promoted to int
+        floats = [t for t in (left, right) if TypeChecker.is_floating(t)]
+        if floats:
+            return TypeChecker.float_type if TypeChecker.float_type in floats else TypeChecker.float32_type
+        if TypeChecker.int64_type in (left, right):
+            return TypeChecker.int64_type
+        return TypeChecker.int_type
+
+    @staticmethod
+    def element_type(typ):
+        return typ.element if isinstance(typ, llvm.VectorType) else typ
+
+    @staticmethod
+    def mask_type(typ):
+        return llvm.VectorType(TypeChecker.bool_type, typ.count)
+
+    @staticmethod
+    def vector_arith_type(left, right):
+        # scalars are splatted and int lanes promoted, as for scalar arithmetic
+        counts = set(t.count for t in (left, right) if isinstance(t, llvm.VectorType))
+        if len(counts) != 1:
+            raise TypeError('vectors of different lengths')
+        elements = set(map(TypeChecker.element_type, (left, right)))
+        if not elements <= set([TypeChecker.int_type, TypeChecker.float_type]):
+            raise TypeError('vector arithmetic needs int or float lanes')
+        element = TypeChecker.float_type if TypeChecker.float_type in elements else TypeChecker.int_type
+        return llvm.VectorType(element, counts.pop())
 
     @staticmethod
     def analyze(func, global_vars):
@@ -23,6 +139,8 @@ class TypeChecker(ast.NodeVisitor):
         super(TypeChecker, self).__init__()
         self.symbol_table = {}
         self.return_type = None
+        # names holding the array a function returns; see owned_result
+        self.owned = set()
         for n, typ in global_vars.items():
             self.symbol_table[n] = typ
 
@@ -32,6 +150,13 @@ class TypeChecker(ast.NodeVisitor):
         argument_types = list(map(type_builder.visit, node.arg_types))
         for arg, arg_type in zip(node.args, argument_types):
             self.symbol_table[arg] = arg_type
+        if isinstance(self.return_type, llvm.PointerType):
+            if isinstance(self.return_type, NDArrayType) or isinstance(self.return_type.pointee, llvm.PointerType):
+                raise NotImplementedError('functions can only return one-dimensional arrays')
+            self.owned = {n.val.name for n in ast.walk(node.body)
+                          if isinstance(n, Return) and isinstance(n.val, Ref) and n.val.index is None}
+            for name in self.owned & set(node.args):
+                raise TypeError('cannot return parameter {}; only arrays created in the function'.format(name))
         btype = None
         if node.body:
             btype = self.visit(node.body)
@@ -61,19 +186,58 @@ class TypeChecker(ast.NodeVisitor):
 
     @assign
     def visit_FuncCall(self, node):
-        if node.name == "create_int_array":
-            return llvm.PointerType(self.int_type)
-        elif node.name == "create_float_array":
-            return llvm.PointerType(self.float_type)
-        elif node.name == "create_bool_array":
-            return llvm.PointerType(self.bool_type)
+        if node.name in self.array_constructors:
+            if len(node.args) != 1 or not self.is_integer(self.visit(node.args[0])):
+                raise TypeError('{} takes a single integer size'.format(node.name))
+            return llvm.PointerType(self.array_constructors[node.name])
+        elif node.name in self.vector_types:
+            return self.vector_constructor(node)
+        elif node.name == 'select':
+            return self.select(node)
         elif node.name not in self.symbol_table:
             raise NotImplementedError('function not found')
         # TODO typecheck arguments
-        for arg in node.args:
-            self.visit(arg)
+        ftype = self.symbol_table[node.name]
+        # arrays returned to Scale code are freed with the caller's arena, unless it returns them
+        node.adopt = isinstance(ftype.return_type, llvm.PointerType) and not self.native(ftype) \
+            and not getattr(node, 'owned', False)
+        params = ftype.args
+        for arg, param in zip(node.args, params):
+            if self.intent(self.visit(arg)) == 'In' and self.intent(param) != 'In':
+                raise TypeError('In array passed to {} as {}'.format(node.name, self.intent(param)))
         return self.symbol_table[node.name].return_type
-    
+
+    def vector_constructor(self, node):
+        # float4(x) splats, float4(x0, x1, x2, x3) sets each lane, float4(a, i) loads a[i:i + 4]
+        vtype = self.vector_types[node.name]
+        arg_types = list(map(self.visit, node.args))
+        scalars = [self.int_type, self.float_type] if vtype.element == self.float_type else [self.int_type]
+        if len(arg_types) == 2 and arg_types[0] == llvm.PointerType(vtype.element) \
+                and arg_types[1] == self.int_type:
+            node.kind = 'load'
+        elif len(arg_types) == 1 and arg_types[0] in scalars:
+            node.kind = 'splat'
+        elif len(arg_types) == vtype.count and all(t in scalars for t in arg_types):
+            node.kind = 'lanes'
+        else:
+            raise TypeError('{} takes a lane value, {} lane values, or an array and an index'.format(
+                node.name, vtype.count))
+        return vtype
+
+    def select(self, node):
+        if len(node.args) != 3:
+            raise TypeError('select takes a condition and two values')
+        cond, left, right = map(self.visit, node.args)
+        if self.is_vector(left) or self.is_vector(right):
+            rtype = left if left == right else self.vector_arith_type(left, right)
+            if cond != self.bool_type and cond != self.mask_type(rtype):
+                raise TypeError('select condition must be a bool or a mask of {} lanes'.format(rtype.count))
+        elif left != right or cond != self.bool_type:
+            raise TypeError('select takes a bool and two values of the same type')
+        else:
+            rtype = left
+        return rtype
+
     @assign
     def visit_Array(self, node):
         if len(node.elts) == 0:
@@ -84,30 +248,54 @@ class TypeChecker(ast.NodeVisitor):
                 raise NotImplementedError('array contains multiple types')
         return llvm.PointerType(typ)
 
+    def operand_types(self, left, right):
+        # literals take the type of the other operand, so float32 code stays float32
+        left_type = self.visit(left)
+        right_type = self.visit(right)
+        if isinstance(left, (IntConst, FloatConst)) and right_type == self.float32_type:
+            left_type = self.float32_type
+        if isinstance(right, (IntConst, FloatConst)) and left_type == self.float32_type:
+            right_type = self.float32_type
+        return left_type, right_type
+
     @assign
     def visit_UnOp(self, node):
         if node.op == Uop.Neg:
             etype = self.visit(node.e)
-            if etype == self.bool_type:
+            if self.element_type(etype) == self.bool_type:
                 raise NotImplementedError('Cannot negate boolean')
-            return etype
+            if self.is_vector(etype):
+                return etype
+            return self.arith_type(etype, etype)
         else:
             etype = self.visit(node.e)
+            if self.is_vector(etype):
+                if etype.element != self.bool_type:
+                    raise TypeError('not is only defined on vector masks')
+                return etype
             return self.bool_type
 
     @assign
     def visit_BinOp(self, node):
-        left_type = self.visit(node.left)
-        right_type = self.visit(node.right)
+        left_type, right_type = self.operand_types(node.left, node.right)
+        if self.is_vector(left_type) or self.is_vector(right_type):
+            if node.op in [Bop.And, Bop.Or]:
+                raise TypeError('and/or are not defined on vectors')
+            vtype = self.vector_arith_type(left_type, right_type)
+            if node.op == Bop.Div:
+                return llvm.VectorType(self.float_type, vtype.count)
+            return vtype
         if node.op in [Bop.Add, Bop.Sub, Bop.Mul, Bop.Mod]:
             if self.bool_type in [left_type, right_type] and left_type != right_type:
                 raise NotImplementedError('boolean mixed arithmetic not supported')
-            if left_type != right_type:
-                return self.float_type
-            else:
+            if left_type == self.bool_type:
                 return left_type
+            return self.arith_type(left_type, right_type)
         elif node.op == Bop.Div:
-            return self.float_type
+            if self.bool_type in [left_type, right_type]:
+                raise NotImplementedError('boolean mixed arithmetic not supported')
+            rtype = self.arith_type(left_type, right_type)
+            return rtype if self.is_floating(rtype) else self.float_type
         else:
             if left_type != right_type:
                 raise NotImplementedError('boolop must have same type')
@@ -115,11 +303,17 @@ class TypeChecker(ast.NodeVisitor):
 
     @assign
     def visit_CmpOp(self, node):
-        left_type = self.visit(node.left)
-        right_type = self.visit(node.right)
+        left_type, right_type = self.operand_types(node.left, node.right)
+        if self.is_vector(left_type) or self.is_vector(right_type):
+            node.operand_type = self.vector_arith_type(left_type, right_type)
+            return self.mask_type(node.operand_type)
 
         if self.bool_type in [left_type, right_type] and left_type != right_type:
                 raise NotImplementedError('cannot compare boolean with nonboolean')
+        if left_type == self.bool_type:
+            node.operand_type = self.bool_type
+        else:
+            node.operand_type = self.arith_type(left_type, right_type)
         return self.bool_type
     
     @assign
@@ -130,51 +324,119 @@ class TypeChecker(ast.NodeVisitor):
             raise TypeError('ref undefined')
         if node.index is None:
             return rtype
-        if rtype in [self.int_type, self.float_type, self.bool_type]:
-            raise TypeError('cannot dereference int/float/bool')
+        if isinstance(rtype, NDArrayType):
+            return self.ndarray_element(rtype, node.index)
+        if not isinstance(rtype, (llvm.PointerType, llvm.VectorType)):
+            raise TypeError('cannot dereference {}'.format(rtype))
         a = self.visit(node.index)
+        if self.is_vector(rtype):
+            if a != self.int_type:
+                raise TypeError('vector lanes are selected by an int')
+            return rtype.element
         if isinstance(a, llvm.PointerType) and a.pointee == self.int_type:
+            element = rtype
             for i in range(len(node.index.elts)):
-                rtype = rtype.pointee
-            return rtype
-        if self.visit(node.index) != self.int_type:
+                element = element.pointee
+            return self.rows_of(rtype, element)
+        if not self.is_integer(a):
             raise TypeError('cannot use non-integer indices')
-        if isinstance(rtype, llvm.PointerType):
-            return rtype.pointee
-        return rtype.pointee 
+        return self.rows_of(rtype, rtype.pointee)
+
+    def rows_of(self, array, typ):
+        # the rows of an In array are read-only as well
+        if self.intent(array) == 'In' and isinstance(typ, llvm.PointerType):
+            typ = copy.copy(typ)
+            typ.intent = 'In'
+        return typ
+
+    def ndarray_element(self, rtype, index):
+        indices = index.elts if isinstance(index, Array) else [index]
+        if len(indices) != rtype.ndim:
+            raise TypeError('{}-dimensional array indexed with {} indices'.format(rtype.ndim, len(indices)))
+        for i in indices:
+            if not self.is_integer(self.visit(i)):
+                raise TypeError('cannot use non-integer indices')
+        return rtype.element
+
+    @assign
+    def visit_Shape(self, node):
+        rtype = self.symbol_table.get(node.name)
+        if not isinstance(rtype, NDArrayType):
+            raise TypeError('{} is not an ndarray'.format(node.name))
+        if self.visit(node.dim) != self.int_type:
+            raise TypeError('shape is indexed by an int')
+        if isinstance(node.dim, IntConst) and not 0 <= node.dim.val < rtype.ndim:
+            raise TypeError('{} has no dimension {}'.format(node.name, node.dim.val))
+        return self.int_type
 
     @assign
     def visit_CastToFloat(self, node):
-        self.visit(node.expr)
+        etype = self.visit(node.expr)
+        if self.is_vector(etype):
+            return llvm.VectorType(self.float_type, etype.count)
         return self.float_type
        
     @assign
     def visit_CastToInt(self, node):
-        self.visit(node.expr)
+        etype = self.visit(node.expr)
+        if self.is_vector(etype):
+            return llvm.VectorType(self.int_type, etype.count)
         return self.int_type
 
+    @assign
+    def visit_Cast(self, node):
+        if self.is_vector(self.visit(node.expr)):
+            raise TypeError('{}() takes a scalar'.format(node.to))
+        return self.scalar_types[node.to]
+
     def visit_Return(self, node):
+        if isinstance(self.return_type, llvm.PointerType) and not isinstance(node.val, Ref):
+            self.owned_result(node.val)
         rtype = self.visit(node.val)
         if rtype != self.return_type:
             raise TypeError('bad return type')
         return rtype
 
+    def owned_result(self, val):
+        # a returned array is handed to the caller, so it is allocated on the heap rather than
+        # in the arena, and the array a call returns is not adopted by the arena
+        if not isinstance(val, FuncCall) or val.name not in self.array_constructors and (
+                val.name not in self.symbol_table or self.native(self.symbol_table[val.name])):
+            raise TypeError('only arrays created in the function can be returned')
+        val.owned = True
+
+    @staticmethod
+    def native(ftype):
+        return getattr(ftype, 'native', False)
+
     def visit_Assign(self, node):
+        if node.ref.name in self.owned and node.ref.index is None:
+            self.owned_result(node.val)
         if node.ref.name in self.symbol_table:
+            if node.ref.index is not None and self.intent(self.symbol_table[node.ref.name]) == 'In':
+                raise TypeError('cannot write to In array {}'.format(node.ref.name))
             self.visit(node.ref)
             if node.ref.index is None:
                 ltype = self.symbol_table[node.ref.name]
+            elif isinstance(self.symbol_table[node.ref.name], NDArrayType):
+                ltype = self.symbol_table[node.ref.name].element
             else:
                 a = self.visit(node.ref.index)
                 if isinstance(a, llvm.PointerType) and a.pointee == self.int_type:
                     ltype = self.symbol_table[node.ref.name]
                     for i in range(len(node.ref.index.elts)):
                         ltype = ltype.pointee
+                elif self.is_vector(self.symbol_table[node.ref.name]):
+                    ltype = self.symbol_table[node.ref.name].element
                 else:
                     ltype = self.symbol_table[node.ref.name].pointee
             rtype = self.visit(node.val)
-            if ltype != rtype:
+            # a[i] = v stores the lanes of v to a[i:i + len(v)]
+            vector_store = node.ref.index is not None and self.is_vector(rtype) and rtype.element == ltype
+            if ltype != rtype and not vector_store:
                 raise TypeError('type mismatch in assignment')
+            if node.ref.index is None and self.intent(rtype) == 'In' and self.intent(ltype) != 'In':
+                raise TypeError('In array assigned to {}'.format(node.ref.name))
         else:
             rtype = self.visit(node.val)
             if node.ref.index is None:
@@ -206,22 +468,65 @@ class TypeChecker(ast.NodeVisitor):
         self.visit(Assign(Ref(node.var), node.min))
         self.visit(node.body)
 
+    def visit_ParallelFor(self, node):
+        # iterations share arrays and reductions only; any other write to an outer scalar
+        # would leave whatever the thread that ran last stored
+        outer = set(self.symbol_table) - {node.var}
+        self.visit_For(node)
+        assigned = {n.ref.name for n in ast.walk(node.body) if isinstance(n, Assign) and n.ref.index is None}
+        for name in sorted(outer & assigned):
+            if not self.is_reduction(node.body, name):
+                raise TypeError('{} is assigned in a prange loop, but not only as {} = {} + e, '
+                                '{} - e or {} * e'.format(name, name, name, name, name))
+
+    @staticmethod
+    def is_reduction(body, name):
+        updates = [n for n in ast.walk(body) if isinstance(n, Assign) and n.ref.name == name]
+        uses = sum(1 for n in ast.walk(body) if isinstance(n, Ref) and n.name == name)
+        for n in updates:
+            val = n.val
+            if n.ref.index is not None or not isinstance(val, BinOp) or \
+                    val.op not in (Bop.Add, Bop.Sub, Bop.Mul) or not isinstance(val.left, Ref) or \
+                    val.left.name != name or val.left.index is not None:
+                return False
+        # each update reads the variable once, and nothing else may
+        return uses == 2 * len(updates)
+
 # Used to parse function signatures.
 class LLVMTypeBuilder(ast.NodeVisitor):
     def __init__(self):
         super(LLVMTypeBuilder, self).__init__()
 
     def visit_Name(self, node: ast.Name):
-        if node.id == 'int':
-            return TypeChecker.int_type
-        if node.id == 'float':
-            return TypeChecker.float_type
-        if node.id == 'bool':
-            return TypeChecker.bool_type
-        raise NotImplementedError('Type names must be either int or float')
+        if node.id in TypeChecker.scalar_types:
+            return TypeChecker.scalar_types[node.id]
+        if node.id in TypeChecker.vector_types:
+            return TypeChecker.vector_types[node.id]
+        raise NotImplementedError('Type names must be {} or a vector type'.format(
+            ', '.join(TypeChecker.scalar_types)))
 
     def visit_List(self, node: ast.List):
         return llvm.PointerType(self.visit(node.elts[0]))
 
+    def visit_Subscript(self, node: ast.Subscript):
+        # ndarray[float, 2], with ndarray from numpy
+        base = node.value
+        name = base.id if isinstance(base, ast.Name) else getattr(base, 'attr', None)
+        params = node.slice.value if isinstance(node.slice, ast.Index) else node.slice
+        if name in TypeChecker.intents:
+            typ = self.visit(params)
+            if not isinstance(typ, llvm.PointerType):
+                raise NotImplementedError('{} applies to array parameters only'.format(name))
+            # a fresh type for each annotation, so the intent stays with this parameter
+            typ.intent = name
+            return typ
+        if name != 'ndarray' or not isinstance(params, ast.Tuple) or len(params.elts) != 2:
+            raise NotImplementedError('array types must be given as ndarray[type, ndim]')
+        element, ndim = params.elts
+        ndim = getattr(ndim, 'n', None)
+        if not isinstance(ndim, int) or ndim < 1:
+            raise NotImplementedError('ndarray dimensions must be a positive int literal')
+        return NDArrayType(self.visit(element), ndim)
+
     def generic_visit(self, node):
         raise NotImplementedError('Unsupported type expression')
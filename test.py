@@ -1,4 +1,4 @@
-from scale import scale
+from scale import scale, In, float32, uint8
 from scale.quote import macros, q
 import numpy as np
 
@@ -19,15 +19,185 @@ def sum_for(a: [[int]], l: int) -> int:
 print(sum_for(arr, len(arr)))
 
 @scale
-def laplace(img: [[int]], out: [[int]], l: int) -> int:
-    for i in range(l-2):
-        for j in range(l-2):
+def laplace(img: In[np.ndarray[int, 2]], out: np.ndarray[int, 2]) -> int:
+    for i in range(img.shape[0]-2):
+        for j in range(img.shape[1]-2):
             out[i,j] = img[i+0,j+1] + img[i+2,j+1] + img[i+1,j+2] + img[i+1,j+0] - 4 * img[i+1,j+1]
     return out[14,14]
-img = np.random.randint(0, 100,(28,28))
-print(laplace(img.tolist(), np.random.randint(0,1,(26, 26)).tolist(), 28))
+img = np.random.randint(0, 100,(28,28)).astype(np.int32)
+print(laplace(img, np.zeros((26, 26), np.int32)))
 test_index = 14
 print(img[test_index+0,test_index+1] + img[test_index+2,test_index+1] + img[test_index+1,test_index+2] + img[test_index+1,test_index+0] - 4 * img[test_index+1,test_index+1])
+
+@scale.declare
+def spec_fact(n: int) -> int: pass
+
+@scale(specialize=['n'])
+def spec_fact(n: int) -> int:
+    if n <= 1:
+        return 1
+    return n * spec_fact(n - 1)
+# recursive calls leave the specialized version for the generic one
+assert spec_fact(5) == spec_fact.func(5) == 120
+
+@scale(specialize=['x'])
+def spec_recip(x: float) -> float:
+    return 1.0 / x
+assert spec_recip(0.0) == float('inf') and spec_recip(-0.0) == float('-inf')
+nan = float('nan')
+spec_recip(nan)
+spec_recip(nan)
+assert len(spec_recip.versions) == 3
+print(spec_fact(5), len(spec_recip.versions))
+
+@scale
+def bound_sum(a: [float], n: int) -> float:
+    s = 0.0
+    for i in range(n):
+        s += a[i]
+    a[n - 1] = s
+    return s
+values = [1.0, 2.0, 3.0]
+call = bound_sum.bind(values, 2)
+assert call() == 3.0 and values == [1.0, 3.0, 3.0]
+# writes to a bound list between calls are seen, not undone by the copy back
+values[0] = 100.0
+assert call() == 103.0 and values == [100.0, 103.0, 3.0]
+array = np.array([1.0, 2.0, 3.0])
+call = bound_sum.bind(array, 3)
+assert call() == 6.0 and call(array, 2) == 3.0 and array.tolist() == [1.0, 3.0, 6.0]
+print(values, array)
+
+def failing_hook(stats):
+    raise ValueError(stats['name'])
+scale.on_compile(failing_hook)
+
+@scale
+def hooked(x: int) -> int:
+    return x + 1
+try:
+    hooked(1)
+except ValueError as e:
+    assert str(e) == 'hooked'
+else:
+    assert False, 'the hook error was swallowed'
+scale.on_compile.remove(failing_hook)
+# the function was installed before the callback failed
+assert hooked.is_compiled and hooked(1) == 2
+print(hooked(1))
+
+@scale
+def linked_h(x: int) -> int:
+    return x * 3 + 1
+
+@scale(link=True)
+def linked_g(n: int) -> int:
+    s = 0
+    for i in range(n):
+        s += linked_h(i)
+    return s
+
+@scale
+def unlinked_g(n: int) -> int:
+    s = 0
+    for i in range(n):
+        s += linked_h(i)
+    return s
+assert linked_g(5) == unlinked_g(5) == 35
+# linking makes the callee's body available, and the default threshold inlines it
+assert '@linked_h' in unlinked_g.opcode() and '@linked_h' not in linked_g.opcode()
+print(linked_g(5))
+
+@scale(instrument=True)
+def counted_h(x: int) -> int:
+    return x + 1
+
+@scale(instrument=True, link=True)
+def counted_g(n: int) -> int:
+    s = 0
+    for i in range(n):
+        s += counted_h(i)
+    return s
+
+@scale(instrument=True, link=True, anonymous=True)
+def counted_anon(n: int) -> int:
+    return counted_h(n)
+assert counted_g(5) == 15 and counted_anon(1) == 2
+# copies of counted_h linked into its callers count into its own counters
+assert counted_h.counters()['entry'] == 6 and counted_g.counters()['entry'] == 1
+print(counted_h.counters())
+
+@scale.vectorize
+def vadd(a: int, b: int) -> int:
+    return a + b
+assert vadd(np.array([1, 2], np.int64), 3).tolist() == [4, 5] and vadd(True, 1) == 2
+# lossy inputs raise rather than being truncated or wrapped
+for lossy in [np.array([1.7, 2.9]), np.array([2 ** 40]), 2.5]:
+    try:
+        vadd(lossy, 0)
+    except TypeError:
+        pass
+    else:
+        assert False, 'lossy input {} was cast'.format(lossy)
+print(vadd([1, 2], 3))
+
+import tempfile
+cache = scale.enable_cache(tempfile.mkdtemp())
+def cached_kernel():
+    @scale
+    def cached_square(x: int) -> int:
+        return x * x
+    return cached_square
+# the second definition loads the object code the first one stored
+assert [cached_kernel()(7) for _ in range(2)] == [49, 49]
+assert (cache.stats()['misses'], cache.stats()['hits']) == (1, 1)
+scale.disable_cache()
+print(cache.stats())
+
+@scale
+def interp_wrap(x: int, b: int) -> int:
+    return (x * 65536 * 65536 + x * 3000000000) % b
+
+@scale
+def interp_bytes(n: int) -> int:
+    s = uint8(0)
+    for i in range(n):
+        s = uint8(s + 200)
+    return int(s)
+
+@scale
+def interp_f32(x: float32) -> float32:
+    return x * float32(3.0) + float32(0.1)
+
+@scale
+def interp_collatz(n: int) -> int:
+    steps = 0
+    for i in range(1000):
+        if n != 1:
+            if n % 2 == 0:
+                n = int(n / 2)
+            else:
+                n = 3 * n + 1
+            steps += 1
+    return steps
+
+@scale
+def interp_squares(a: [int], n: int) -> int:
+    r = create_int_array(n)
+    s = 0
+    for i in range(n):
+        r[i] = a[i] * a[i]
+        a[i] = r[i] - 1
+        s += r[i]
+    return s
+# the interpreter wraps, rounds and takes remainders as the native code does
+for fn, args in [(interp_wrap, (12345, 7)), (interp_wrap, (-12345, 7)), (interp_bytes, (5,)),
+                 (interp_f32, (1.1,)), (interp_collatz, (27,))]:
+    assert fn.interpret(*args) == fn(*args), fn.scale_name
+native_arg, interp_arg = [1, 2, 3], [1, 2, 3]
+assert interp_squares.interpret(interp_arg, 3) == interp_squares(native_arg, 3) == 14
+assert interp_arg == native_arg == [0, 3, 8]
+print(interp_wrap(12345, 7), interp_f32(1.1), interp_collatz(27))
 '''
 def gen_square(x):
     return q[x * x]